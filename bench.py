@@ -0,0 +1,409 @@
+#!/usr/bin/env python
+"""Headless benchmarks for ted.
+
+Opens generated files in the editor and drives it with scripted keys over
+a socket pair in place of a terminal, timing every frame from the keys
+being sent to the screen update being written. Reports frame latency
+percentiles, bytes written per frame, highlighting, macro and replace speed
+and open and save throughput.
+
+    python bench.py                      # run everything
+    python bench.py --json new.json      # and keep the results
+    python bench.py --compare old.json   # and compare with a kept run
+
+The fixtures are generated from a fixed seed into FIXTURE_DIR the first
+time they are needed and reused after that, so runs on different commits
+see the same files. --scale shrinks or grows them for a quicker or
+heavier run; only compare runs made at the same scale.
+"""
+
+import argparse
+import json
+import os
+import random
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+import ted
+
+FIXTURE_DIR = os.path.join(tempfile.gettempdir(), 'ted-bench')
+SCREEN_ROWS = 48
+SCREEN_COLS = 160
+REGRESSION = 0.10
+
+ARROW_DOWN = '\x1b[B'
+PAGE_UP = '\x1b[5~'
+PAGE_DOWN = '\x1b[6~'
+HOME_KEY = '\x1b[H'
+END_KEY = '\x1b[F'
+
+# Twenty keys that comment a line out and go to the next.
+MACRO_KEYS = HOME_KEY + '// ' + END_KEY + ' /* checked */' + ARROW_DOWN
+
+C_WORDS = ['value', 'count', 'buffer', 'index', 'result', 'node', 'size',
+           'offset', 'length', 'state', 'flags', 'next', 'data', 'key']
+C_TYPES = ['int', 'long', 'char *', 'unsigned', 'double', 'struct node *']
+
+# Fixtures
+
+def make_c_file(path, lines):
+    """Write `lines` lines of plausible C: functions, loops, string and
+    number literals, line and block comments, and some tab indentation."""
+    rng = random.Random(1)
+    out = []
+    n = 0
+    while n < lines:
+        name = '%s_%d' % (rng.choice(C_WORDS), n)
+        body = [
+            '/*',
+            ' * %s: %s the %s.' % (name, rng.choice(C_WORDS),
+                                   rng.choice(C_WORDS)),
+            ' */',
+            'static %s %s(%s %s, int %s)' % (
+                rng.choice(C_TYPES), name, rng.choice(C_TYPES),
+                rng.choice(C_WORDS), rng.choice(C_WORDS)),
+            '{',
+        ]
+        for i in xrange(rng.randint(4, 20)):
+            indent = '\t' if rng.random() < 0.3 else '    '
+            a, b = rng.choice(C_WORDS), rng.choice(C_WORDS)
+            kind = rng.random()
+            if kind < 0.3:
+                line = '%s = %s + %d;' % (a, b, rng.randint(0, 99999))
+            elif kind < 0.5:
+                line = 'if (%s > %s) return %d; // %s' % (
+                    a, b, rng.randint(0, 9), rng.choice(C_WORDS))
+            elif kind < 0.7:
+                line = 'printf("%s=%%d\\n", %s);' % (a, a)
+            elif kind < 0.85:
+                line = 'for (i = 0; i < %s; i++) %s[i] = %d.%d;' % (
+                    a, b, rng.randint(0, 99), rng.randint(0, 99))
+            else:
+                line = 'while (%s--) { %s ^= 0x%x; }' % (a, b,
+                                                        rng.getrandbits(16))
+            body.append(indent + line)
+        body.extend(['    return %s;' % rng.choice(C_WORDS), '}', ''])
+        out.extend(body)
+        n += len(body)
+    write_fixture(path, '\n'.join(out[:lines]) + '\n')
+
+def make_long_line(path, size):
+    """Write a single line of `size` bytes, like minified code."""
+    rng = random.Random(2)
+    words = ['%s=%d;' % (rng.choice(C_WORDS), rng.randint(0, 999))
+             for i in xrange(4096)]
+    block = ''.join(words)
+    out = block * (size // len(block)) + block[:size % len(block)]
+    write_fixture(path, out + '\n')
+
+def make_tsv(path, lines, columns=12):
+    """Write `lines` rows of tab separated columns of varying width."""
+    rng = random.Random(3)
+    out = []
+    for i in xrange(lines):
+        out.append('\t'.join(
+            rng.choice(C_WORDS)[:rng.randint(1, 6)] * rng.randint(1, 3)
+            for c in xrange(columns)))
+    write_fixture(path, '\n'.join(out) + '\n')
+
+def write_fixture(path, text):
+    partial = path + '.part'
+    with open(partial, 'wb') as f:
+        f.write(text)
+    os.rename(partial, path)
+
+def fixture(name, scale):
+    """Return the path of fixture `name` at `scale`, generating it if it
+    doesn't exist yet."""
+    makers = {
+        'c': ('c', make_c_file, 1000000),
+        'long': ('txt', make_long_line, 50 * 1024 * 1024),
+        'tsv': ('tsv', make_tsv, 200000),
+    }
+    ext, make, amount = makers[name]
+    amount = max(int(amount * scale), 1)
+    path = os.path.join(FIXTURE_DIR, '%s-%d.%s' % (name, amount, ext))
+    if not os.path.exists(path):
+        if not os.path.isdir(FIXTURE_DIR):
+            os.makedirs(FIXTURE_DIR)
+        sys.stderr.write('generating %s\n' % path)
+        make(path, amount)
+    return path
+
+# Driving the editor
+
+class Driver(object):
+    """Runs the editor against one end of a socket pair, standing in for
+    the terminal at the other end."""
+
+    def __init__(self, rows=SCREEN_ROWS, cols=SCREEN_COLS):
+        self._term, self._editor = socket.socketpair()
+        self._editor.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 1 << 20)
+        self._term.setblocking(False)
+        self.fd = self._editor.fileno()
+        self.rows = rows
+        self.cols = cols
+
+    def reset(self):
+        """Close the files being edited and put the editor back the way
+        it starts, so one benchmark doesn't leave anything behind for the
+        next."""
+        config = ted.CONFIG
+        states = [config] + [buffer.state for buffer in config['buffers']
+                             if buffer.state is not None]
+        for state in states:
+            if state['writer'] is not None:
+                state['writer'].join()
+            if state['source'] is not None:
+                state['source'].close()
+        ted.editor_close_journals(discard=True)
+        if config['project_search'] is not None:
+            config['project_search'].cancel()
+        # The idle jobs are registered once, as ted is imported.
+        idle_jobs = config['idle_jobs']
+        config.clear()
+        config.update(ted.editor_state())
+        config.update(idle_jobs=idle_jobs, screen_rows=self.rows,
+                      screen_cols=self.cols)
+        ted.set_status_message('')
+
+    def frame(self):
+        """Redraw, returning the number of bytes written."""
+        ted.refresh_screen(self.fd)
+        return self.drain()
+
+    def step(self, keys):
+        """Send `keys`, let the editor handle all of them and redraw.
+        Returns the seconds that took and the bytes written. Keys bigger
+        than the socket's buffer must be a single bracketed paste."""
+        start = time.time()
+        if len(keys) > ted.INPUT_SIZE:
+            sender = threading.Thread(target=self._send, args=(keys,))
+            sender.start()
+            ted.process_key_press(self.fd)
+            sender.join()
+        else:
+            self._send(keys)
+            ted.process_key_press(self.fd)
+        while ted.input_pending(self.fd):
+            ted.process_key_press(self.fd)
+        ted.refresh_screen(self.fd)
+        return time.time() - start, self.drain()
+
+    def drain(self):
+        total = 0
+        while True:
+            try:
+                data = self._term.recv(1 << 20)
+            except socket.error:
+                return total
+            total += len(data)
+
+    def _send(self, keys):
+        self._term.setblocking(True)
+        self._term.sendall(keys)
+        self._term.setblocking(False)
+
+# Measurements
+
+def percentile(ordered, p):
+    """The nearest-rank `p`th percentile of the sorted list `ordered`."""
+    return ordered[max(int(round(p / 100.0 * len(ordered))) - 1, 0)]
+
+def frame_stats(frames):
+    """Summarise a list of (seconds, bytes) frames."""
+    times = sorted(t for t, n in frames)
+    return {
+        'frames': len(frames),
+        'p50': percentile(times, 50),
+        'p90': percentile(times, 90),
+        'p99': percentile(times, 99),
+        'max': times[-1],
+        'bytes': sum(n for t, n in frames) // len(frames),
+    }
+
+def run_steps(driver, steps):
+    return frame_stats([driver.step(keys) for keys in steps])
+
+def bench_open(driver, path):
+    """Time from opening `path` to the first frame, and until the whole
+    file is available."""
+    driver.reset()
+    start = time.time()
+    ted.editor_open(path)
+    driver.frame()
+    first = time.time() - start
+    source = ted.CONFIG['source']
+    if source is not None:
+        source.index_until(sys.maxint)
+        ted.editor_load_source()
+    seconds = time.time() - start
+    size = os.path.getsize(path)
+    return {'first_frame': first, 'seconds': seconds,
+            'mb_s': size / seconds / (1 << 20)}
+
+def bench_highlight(limit):
+    """Time highlighting the first `limit` lines from scratch."""
+    rows = ted.CONFIG['row']
+    count = min(limit, len(rows))
+    for at in xrange(count):
+        rows[at]._hl = None
+    start = time.time()
+    for at in xrange(count):
+        rows[at].hl
+    seconds = time.time() - start
+    return {'lines': count, 'seconds': seconds,
+            'lines_s': count / max(seconds, 1e-9)}
+
+def bench_macro(driver, count):
+    """Time playing a macro of MACRO_KEYS over the next `count` lines."""
+    driver.step(ted.ctrl('k') + MACRO_KEYS + ted.ctrl('k'))
+    start = time.time()
+    driver.step(ted.ctrl('e') + '%d\r' % count)
+    seconds = time.time() - start
+    return {'lines': count, 'seconds': seconds,
+            'lines_s': count / max(seconds, 1e-9)}
+
+def bench_replace(driver, query, replacement):
+    """Time replacing every match of `query` in the buffer, search
+    included, and drawing the screen after."""
+    start = time.time()
+    count, lines = ted.editor_replace_all(query, replacement)
+    driver.frame()
+    seconds = time.time() - start
+    return {'lines': lines, 'seconds': seconds,
+            'lines_s': lines / max(seconds, 1e-9)}
+
+def bench_save(driver, scratch):
+    """Time saving the buffer to `scratch`."""
+    ted.CONFIG['filename'] = scratch
+    start = time.time()
+    driver.step(ted.ctrl('s'))
+    if ted.CONFIG['writer'] is not None:
+        ted.CONFIG['writer'].join()
+        driver.frame()
+    seconds = time.time() - start
+    size = os.path.getsize(scratch)
+    return {'seconds': seconds, 'mb_s': size / seconds / (1 << 20)}
+
+def typing_keys(count):
+    text = 'result = compute(value, 42); /* "note" */\r'
+    return list((text * (count // len(text) + 1))[:count])
+
+def paste_keys(path, size):
+    with open(path, 'rb') as f:
+        text = f.read(size).replace('\n', '\r')
+    return [ted.PASTE_START + text + ted.PASTE_END]
+
+def search_keys(queries):
+    steps = []
+    for query in queries:
+        steps.append(ted.ctrl('f') + query + ARROW_DOWN * 3 + '\r')
+    return steps
+
+def scroll_keys(lines, pages):
+    return [ARROW_DOWN] * lines + [PAGE_DOWN] * pages + [PAGE_UP] * pages
+
+def bench_file(driver, name, path, keys, scratch):
+    """Run every scenario against `path`, returning name: results pairs."""
+    results = [('%s/open' % name, bench_open(driver, path))]
+    results.append(('%s/highlight' % name, bench_highlight(20000)))
+    results.append(('%s/scroll' % name,
+                    run_steps(driver, scroll_keys(keys, keys // 10))))
+
+    # Work in the middle of the file, on its only line if it has just one.
+    middle = (len(ted.CONFIG['row']) - 1) // 2
+    ted.editor_load_until(middle)
+    ted.CONFIG['cy'] = middle
+    driver.frame()
+    results.append(('%s/typing' % name,
+                    run_steps(driver, typing_keys(keys))))
+    results.append(('%s/paste' % name,
+                    run_steps(driver, paste_keys(path, 100 * 1024))))
+    results.append(('%s/search' % name, run_steps(driver, search_keys(
+        ['compute', 'value = ', 'zzzz', 'e', 'return']))))
+    lines = len(ted.CONFIG['row']) - ted.CONFIG['cy']
+    results.append(('%s/macro' % name,
+                    bench_macro(driver, min(keys * 20, lines))))
+    results.append(('%s/replace' % name,
+                    bench_replace(driver, 'value', 'amount')))
+    results.append(('%s/save' % name, bench_save(driver, scratch)))
+    return results
+
+# Reporting
+
+def describe(result):
+    if 'p50' in result:
+        return ('%5d frames  p50 %7.2fms  p90 %7.2fms  p99 %7.2fms  '
+                'max %8.2fms  %6d B/frame' % (
+                    result['frames'], result['p50'] * 1000,
+                    result['p90'] * 1000, result['p99'] * 1000,
+                    result['max'] * 1000, result['bytes']))
+    if 'lines_s' in result:
+        return '%7d lines in %.3fs  %10.0f lines/s' % (
+            result['lines'], result['seconds'], result['lines_s'])
+    text = '%.3fs  %7.1f MB/s' % (result['seconds'], result['mb_s'])
+    if 'first_frame' in result:
+        text += '  first frame %.2fms' % (result['first_frame'] * 1000)
+    return text
+
+def headline(result):
+    """The number a result is compared on; lower is better."""
+    if 'p50' in result:
+        return result['p50']
+    return result['seconds']
+
+def report(results, baseline=None):
+    width = max(len(name) for name, result in results)
+    for name, result in results:
+        line = '%-*s  %s' % (width, name, describe(result))
+        if baseline and name in baseline:
+            old = headline(baseline[name])
+            change = (headline(result) - old) / old if old else 0.0
+            line += '  %+6.1f%%%s' % (change * 100,
+                                      ' !' if change > REGRESSION else '')
+        print line
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark ted headlessly.')
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='fixture size relative to the default')
+    parser.add_argument('--keys', type=int, default=500,
+                        help='keys typed and lines scrolled per file')
+    parser.add_argument('--only', action='append', choices=['c', 'long', 'tsv'],
+                        help='fixture to run, may be repeated')
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--compare', help='results file to compare with')
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+
+    driver = Driver()
+    scratch_dir = tempfile.mkdtemp(prefix='ted-bench-')
+    results = []
+    try:
+        for name in args.only or ['c', 'long', 'tsv']:
+            path = fixture(name, args.scale)
+            keys = args.keys if name != 'long' else max(args.keys // 10, 1)
+            scratch = os.path.join(scratch_dir, os.path.basename(path))
+            results.extend(bench_file(driver, name, path, keys, scratch))
+            driver.reset()
+    finally:
+        shutil.rmtree(scratch_dir)
+
+    report(results, baseline)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'scale': args.scale, 'keys': args.keys,
+                       'results': dict(results)}, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
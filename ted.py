@@ -1,20 +1,85 @@
 #!/usr/bin/env python
 
+import array
 import atexit
+import bisect
+import collections
+import cProfile
 import curses.ascii
 import errno
 import fcntl
+import fnmatch
 import functools
+import hashlib
+import itertools
+import json
+import marshal
+import mmap
+import multiprocessing
 import os
+import Queue
+import re
+import select
+import signal
+import socket
+import stat
 import sys
 import struct
+import tempfile
 import termios
+import threading
 import time
+import traceback
 import tty
 
 VERSION = '0.0.1'
 TAB_STOP = 8
 QUIT_TIMES = 3
+LARGE_FILE_SIZE = 32 * 1024 * 1024
+BACKGROUND_SAVE_SIZE = 4 * 1024 * 1024
+SEARCH_WAIT = 0.1
+INPUT_SIZE = 64 * 1024
+ESCAPE_WAIT = 0.1
+PROFILE_FILE = 'ted-profile'
+STATUS_TIMEOUT = 5
+PROGRESS_INTERVAL = 0.1
+IDLE_SLICE = 0.005
+SYNTAX_CHECKPOINT = 1024
+SYNTAX_CHUNK = 8 * 1024
+# A row is highlighted this many characters at a time, and an edit to a
+# long one takes its highlighting back to the last step that starts at
+# least SYNTAX_LOOKBEHIND characters before it.
+SYNTAX_STEP = 1024
+SYNTAX_LOOKBEHIND = 64
+MEMORY_BUDGET = 256 * 1024 * 1024
+# What a row costs besides its text, roughly, in bytes.
+ROW_SIZE = 256
+FOLLOW_INTERVAL = 0.5
+FOLLOW_CHUNK = 4 * 1024 * 1024
+# How much of a command's output read from a pipe is kept in memory before
+# the rest goes to a temporary file.
+PIPE_MEMORY = 64 * 1024 * 1024
+# How many rows read from a mapped file or pipe are kept loaded, not
+# counting those that have been changed.
+LOADED_ROWS = 50000
+IGNORE_FILES = ('.gitignore', '.ignore')
+VCS_DIRS = ('.git', '.hg', '.svn')
+# How much of a matching line a project search shows.
+HIT_WIDTH = 1024
+SERVER_DIR = os.path.join(os.environ.get('XDG_RUNTIME_DIR') or
+                          tempfile.gettempdir(), 'ted-%d' % os.getuid())
+SYNTAX_DIRS = [
+    os.path.join(os.environ.get('XDG_CONFIG_HOME') or
+                 os.path.expanduser('~/.config'), 'ted', 'syntax'),
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'syntax'),
+]
+CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME') or
+                         os.path.expanduser('~/.cache'), 'ted')
+STATE_DIR = os.path.join(os.environ.get('XDG_STATE_HOME') or
+                         os.path.expanduser('~/.local/state'), 'ted')
+JOURNAL_DIR = os.path.join(STATE_DIR, 'journal')
+# Where the server writes what went wrong if it dies.
+SERVER_LOG = os.path.join(STATE_DIR, 'server.log')
 
 HL_NORMAL = 0
 HL_NUMBER = 1
@@ -37,139 +102,1590 @@ SYNTAX_TO_COLOR = {
 }
 
 class Row(object):
-    def __init__(self, chars, idx):
+    def __init__(self, chars):
+        self._leaf = None
+        self._gap = None
+        self._render = None
+        self._tabs = None
+        self._hl_resume = None
+        self._hl_checkpoints = None
+        self.hl_open_comment = False
+        self.hl_in_comment = None
         self.chars = chars
-        self.idx = idx
-        self.hl_open_comment = 0
+
+    def __len__(self):
+        if self._chars is None:
+            return len(self._gap)
+        return len(self._chars)
+
+    @property
+    def idx(self):
+        return CONFIG['row'].index(self)
 
     @property
     def hl(self):
-        hl = [HL_NORMAL] * len(self.chars)
-
-        if not CONFIG['syntax']:
-            return hl
-
-        singleline_comment_start = CONFIG['syntax']['singleline_comment_start']
-        mcs = CONFIG['syntax']['multiline_comment_start']
-        mce = CONFIG['syntax']['multiline_comment_end']
-        prev_sep = True
-        string_delim = None
-        in_comment = self.idx > 0 and CONFIG['row'][self.idx - 1].hl_open_comment
-
-        l = len(self.chars)
-        i = 0
-        while i < l:
-            prev_hl = hl[i - 1] if i > 0 else HL_NORMAL
-            c = self.chars[i]
-
-            if singleline_comment_start and not string_delim and not in_comment:
-                if self.chars[i:].startswith(singleline_comment_start):
-                    hl[i:] = [HL_COMMENT] * (len(self.chars) - i)
+        """The highlighted runs of the row, as an array of (start, length,
+        class) triples in order. Characters outside them are HL_NORMAL.
+        A long row is only highlighted as far as `row_extend_syntax` has
+        been asked to go."""
+        if self._hl is None:
+            with timed('highlight'):
+                editor_update_syntax(self.idx)
+        return self._hl
+
+    @hl.setter
+    def hl(self, hl):
+        self._hl = hl
+
+    @property
+    def chars(self):
+        if self._chars is None:
+            self._chars = str(self._gap)
+        return self._chars
+
+    @chars.setter
+    def chars(self, chars):
+        self._chars = chars
+        self._gap = None
+        self._hl = None
+        self._render = None
+
+    @property
+    def render(self):
+        if self._render is None:
+            row_update_render(self)
+        return self._render
+
+    @property
+    def tabs(self):
+        """The positions of the row's tabs and the render column each one
+        ends at, as two arrays, or None for a row without tabs, where
+        characters and columns are the same."""
+        if self._render is None:
+            row_update_render(self)
+        return self._tabs
+
+
+class GapBuffer(object):
+    """The characters of the line being edited.
+
+    They sit in a bytearray with a gap at the last edit position, so typing
+    or deleting only moves the bytes between the previous edit and this
+    one instead of copying the whole line.
+
+    The tabs are kept track of the same way, so columns can be worked out
+    without the line being put back together. Those before the gap are kept
+    by position, with the render column each ends at. Those after it are
+    kept by how far they are from the end of the line, nearest the gap
+    last, with their ends negated and counted from an arbitrary origin: an
+    edit before them moves them all alike, so only the nearest one's real
+    end has to be worked out to know all of theirs."""
+
+    MIN_GAP = 64
+
+    def __init__(self, s='', tabs=None):
+        """`tabs`, when given, is the row's tab map, to save finding the
+        tabs again."""
+        self._buf = bytearray(s)
+        self._gap_start = self._gap_end = len(self._buf)
+        if tabs is None and '\t' in s:
+            tabs = expand_tabs(s)[1:]
+        if tabs is None:
+            self._tabs = array.array('I')
+            self._ends = array.array('I')
+        else:
+            self._tabs = array.array('I', tabs[0])
+            self._ends = array.array('I', tabs[1])
+        self._tail_tabs = array.array('I')
+        self._tail_ends = array.array('l')
+
+    def __len__(self):
+        return len(self._buf) - (self._gap_end - self._gap_start)
+
+    def __str__(self):
+        return (str(self._buf[:self._gap_start]) +
+                str(self._buf[self._gap_end:]))
+
+    def slice(self, start, end):
+        gap = self._gap_end - self._gap_start
+        if end <= self._gap_start:
+            return str(self._buf[start:end])
+        if start >= self._gap_start:
+            return str(self._buf[start + gap:end + gap])
+        return (str(self._buf[start:self._gap_start]) +
+                str(self._buf[self._gap_end:end + gap]))
+
+    def insert(self, at, s):
+        self._move_gap(at)
+        if len(s) > self._gap_end - self._gap_start:
+            grow = max(len(s), self.MIN_GAP, len(self) // 4)
+            self._buf[self._gap_start:self._gap_start] = bytearray(grow)
+            self._gap_end += grow
+        self._buf[self._gap_start:self._gap_start + len(s)] = s
+        at = self._gap_start
+        self._gap_start += len(s)
+        tab = s.find('\t')
+        while tab != -1:
+            self._push_tab(at + tab)
+            tab = s.find('\t', tab + 1)
+
+    def delete(self, at, n=1):
+        self._move_gap(at)
+        n = min(n, len(self._buf) - self._gap_end)
+        # The tabs after the gap are measured from the end of the line.
+        after = len(self) - at - n
+        while self._tail_tabs and self._tail_tabs[-1] > after:
+            self._tail_tabs.pop()
+            self._tail_ends.pop()
+        self._gap_end += n
+
+    def _move_gap(self, at):
+        start, end = self._gap_start, self._gap_end
+        length = len(self)
+        shift = self._tail_shift(start)
+        if at < start:
+            n = start - at
+            self._buf[end - n:end] = self._buf[at:start]
+            self._gap_start, self._gap_end = at, end - n
+            k = bisect.bisect_left(self._tabs, at)
+            self._tail_tabs.extend(array.array(
+                'I', [length - tab for tab in reversed(self._tabs[k:])]))
+            self._tail_ends.extend(array.array(
+                'l', [shift - col for col in reversed(self._ends[k:])]))
+            del self._tabs[k:]
+            del self._ends[k:]
+        elif at > start:
+            n = at - start
+            self._buf[start:start + n] = self._buf[end:end + n]
+            self._gap_start, self._gap_end = start + n, end + n
+            k = bisect.bisect_right(self._tail_tabs, length - at)
+            self._tabs.extend(array.array(
+                'I', [length - tab for tab in reversed(self._tail_tabs[k:])]))
+            self._ends.extend(array.array(
+                'I', [shift - col for col in reversed(self._tail_ends[k:])]))
+            del self._tail_tabs[k:]
+            del self._tail_ends[k:]
+
+    def _push_tab(self, at):
+        """Note a tab at `at`, which is before the gap, after the others."""
+        col = self._column_before(at)
+        self._tabs.append(at)
+        self._ends.append(col + TAB_STOP - col % TAB_STOP)
+
+    def _column_before(self, at):
+        """The column of `at`, where no tab before the gap comes after it."""
+        if not self._tabs:
+            return at
+        return self._ends[-1] + at - self._tabs[-1] - 1
+
+    def _tail_shift(self, start):
+        """The origin the ends of the tabs after the gap are counted back
+        from, were the gap at `start`: the real end of one is the shift
+        less its entry."""
+        if not self._tail_tabs:
+            return 0
+        at = len(self) - self._tail_tabs[-1]
+        col = self._column_before(start) + at - start
+        return col + TAB_STOP - col % TAB_STOP + self._tail_ends[-1]
+
+    def has_tabs(self):
+        return bool(self._tabs or self._tail_tabs)
+
+    def column(self, cx):
+        """The render column character `cx` starts at, as `row_cx_to_rx`."""
+        start = self._gap_start
+        if cx <= start:
+            i = bisect.bisect_left(self._tabs, cx)
+            if not i:
+                return cx
+            return self._ends[i - 1] + cx - self._tabs[i - 1] - 1
+        k = bisect.bisect_right(self._tail_tabs, len(self) - cx)
+        if k == len(self._tail_tabs):
+            return self._column_before(start) + cx - start
+        at = len(self) - self._tail_tabs[k]
+        end = self._tail_shift(start) - self._tail_ends[k]
+        return end + cx - at - 1
+
+    def columns(self):
+        """How many columns the line takes up."""
+        return self.column(len(self))
+
+    def render(self, start, end):
+        """Render columns `start` to `end`, with the tabs expanded. Only
+        the characters they show are put together."""
+        if not self.has_tabs():
+            return self.slice(min(start, len(self)), min(end, len(self)))
+        first = min(self.index(start), len(self))
+        last = min(self.index(end) + 1, len(self))
+        col = self.column(first)
+        render = expand_tabs(self.slice(first, last), col)[0]
+        return render[start - col:end - col]
+
+    def index(self, rx):
+        """The character render column `rx` shows, as `row_column`."""
+        i = bisect.bisect_right(self._ends, rx)
+        if i < len(self._tabs):
+            following = self._tabs[i]
+        elif self._tail_tabs:
+            shift = self._tail_shift(self._gap_start)
+            # The entries are the ends negated, so in order.
+            k = bisect.bisect_left(self._tail_ends, shift - rx)
+            if k < len(self._tail_tabs):
+                cx = (len(self) - self._tail_tabs[k] + 1 + rx -
+                      (shift - self._tail_ends[k]))
+                if k:
+                    cx = min(cx, len(self) - self._tail_tabs[k - 1])
+                return cx
+            following = len(self) - self._tail_tabs[-1]
+        else:
+            following = None
+        if not i:
+            cx = rx
+        else:
+            cx = self._tabs[i - 1] + 1 + rx - self._ends[i - 1]
+        if following is not None:
+            cx = min(cx, following)
+        return cx
+
+
+class MappedFile(object):
+    """A file mapped into memory, with an index of where its lines start.
+
+    The index records how many newlines come before the end of each
+    CHUNK-sized block of the file. It is built a block at a time, by
+    `index_until` for the lines that are needed right away and by a
+    background thread for the rest, so a large file can be shown before it
+    has been read through."""
+
+    CHUNK = 1 << 16
+
+    def __init__(self, filename):
+        with open(filename, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.stat = os.fstat(f.fileno())
+        self.size = len(self._map)
+        self._counts = array.array('L')
+        self._lock = threading.Lock()
+        self._last = (0, 0)
+        self._stop = False
+        self._thread = None
+        self.newlines = 0
+        self.done = not self.size
+
+    @property
+    def lines(self):
+        """The number of lines known so far. The last line only counts once
+        the whole file has been indexed, since until then it may be cut
+        short."""
+        done = self.done
+        return self.newlines + 1 if done else self.newlines
+
+    def start(self):
+        self._thread = threading.Thread(target=self._index_all)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def close(self):
+        self._stop = True
+        if self._thread is not None:
+            self._thread.join()
+        self._map.close()
+
+    def index_until(self, lines):
+        while not self.done and self.newlines < lines:
+            self._index_chunk()
+
+    def _index_all(self):
+        while not self._stop and not self.done:
+            self._index_chunk()
+
+    def _index_chunk(self):
+        with self._lock:
+            if self.done:
+                return
+            start = len(self._counts) * self.CHUNK
+            self._counts.append(self.newlines +
+                                self._map[start:start + self.CHUNK].count('\n'))
+            self.newlines = self._counts[-1]
+            if start + self.CHUNK >= self.size:
+                self.done = True
+
+    def line(self, k):
+        start = self.line_start(k)
+        end = self._map.find('\n', start)
+        if end == -1:
+            end = self.size
+        return self._map[start:end]
+
+    def extent(self, start, end=None):
+        """Return the byte range taken up by lines `start` to `end`, not
+        counting the newline after the last one. With no `end`, the range
+        runs to the end of the file."""
+        if end is None or end > self.newlines:
+            return self.line_start(start), self.size
+        return self.line_start(start), self.line_start(end) - 1
+
+    def read(self, start, end):
+        return self._map[start:end]
+
+    def find(self, sub, start, end):
+        return self._map.find(sub, start, end)
+
+    def rfind(self, sub, start, end):
+        return self._map.rfind(sub, start, end)
+
+    def line_start(self, k):
+        if k == 0:
+            return 0
+        # Count newlines from the start of the block holding the k-th one,
+        # or from the last line looked up when that is closer, as it is when
+        # the screen is drawn a line at a time.
+        c = bisect.bisect_left(self._counts, k)
+        skip = k - (self._counts[c - 1] if c else 0)
+        pos = c * self.CHUNK
+        last_k, last_pos = self._last
+        if last_k <= k and k - last_k < skip:
+            skip = k - last_k
+            pos = last_pos
+        for _ in xrange(skip):
+            pos = self._map.find('\n', pos) + 1
+        self._last = (k, pos)
+        return pos
+
+
+class PipeFile(MappedFile):
+    """The output of a command, read from a pipe by a background thread
+    as it comes and indexed as it is read, so its lines can be shown as soon
+    as they arrive. Given a `limit`, no more than that many bytes are read,
+    which is how a file that may be truncated under the editor is copied
+    rather than mapped.
+
+    The first `memory` bytes are kept in memory. Beyond that everything is
+    written to a temporary file instead, which is mapped into memory again
+    whenever it has grown, so only the parts of it being looked at take up
+    any. `size`, `newlines` and the index only ever cover what can be read
+    through the map already. `done` is set at the end of the output."""
+
+    READ = 1 << 16
+    # The most read from the pipe before it is made available, when it
+    # comes faster than that.
+    BATCH = 4 << 20
+
+    def __init__(self, fd, memory=PIPE_MEMORY, limit=None):
+        self._fd = fd
+        self._memory = memory
+        self._left = limit
+        self._map = bytearray()
+        self._file = None
+        self.stat = None
+        self.size = 0
+        self.error = None
+        self._counts = array.array('L')
+        self._lock = threading.Lock()
+        self._last = (0, 0)
+        self._stop = False
+        self._thread = None
+        self.newlines = 0
+        self.done = False
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def close(self):
+        # The reader may be waiting on the pipe, so it isn't waited for;
+        # it stops when it next wakes up.
+        self._stop = True
+
+    def index_until(self, lines):
+        # The lines are indexed as they arrive and can't be hurried, but
+        # a file being copied has them all coming soon.
+        while self._left is not None and not self.done and (
+                self.newlines < lines):
+            time.sleep(0.001)
+
+    def line(self, k):
+        return str(MappedFile.line(self, k))
+
+    def read(self, start, end):
+        return str(self._map[start:end])
+
+    def _read(self):
+        if self._left is None:
+            return os.read(self._fd, self.READ)
+        data = os.read(self._fd, min(self.READ, self._left))
+        self._left -= len(data)
+        return data
+
+    def _run(self):
+        try:
+            while not self._stop:
+                data = self._read()
+                if not data:
+                    break
+                batch = [data]
+                size = len(data)
+                while (size < self.BATCH and not self._stop and
+                       select.select([self._fd], [], [], 0)[0]):
+                    data = self._read()
+                    if not data:
+                        break
+                    batch.append(data)
+                    size += len(data)
+                self._add(''.join(batch))
+                if not data:
                     break
+        except EnvironmentError as e:
+            self.error = e
+        finally:
+            os.close(self._fd)
+            if self._file is not None:
+                # The map keeps the file open for itself.
+                self._file.close()
+            self.done = True
 
-            if mcs and mce and not string_delim:
-                if in_comment:
-                    hl[i] = HL_MLCOMMENT
-                    if self.chars.startswith(mce, i):
-                        hl[i:i+len(mce)] = [HL_MLCOMMENT] * len(mce)
-                        i += len(mce)
-                        in_comment = False
-                        prev_sep = 1
-                    else:
-                        i += 1
-                        continue
-                elif self.chars.startswith(mcs, i):
-                    hl[i:i+len(mcs)] = [HL_MLCOMMENT] * len(mcs)
-                    i += len(mcs)
-                    in_comment = True
-                    continue
+    def _add(self, data):
+        """Make `data` readable after what came before, then index it."""
+        offset = self.size
+        if self._file is None and offset + len(data) <= self._memory:
+            self._map.extend(data)
+        else:
+            if self._file is None:
+                self._file = tempfile.TemporaryFile(prefix='ted-pipe-')
+                self._file.write(self._map)
+            self._file.write(data)
+            self._file.flush()
+            # The old map goes once nothing is reading through it.
+            self._map = mmap.mmap(self._file.fileno(), offset + len(data),
+                                  access=mmap.ACCESS_READ)
+        newlines = self.newlines
+        pos = 0
+        with self._lock:
+            while True:
+                end = (len(self._counts) + 1) * self.CHUNK - offset
+                if end > len(data):
+                    break
+                newlines += data.count('\n', pos, end)
+                self._counts.append(newlines)
+                pos = end
+            self.size = offset + len(data)
+            self.newlines = newlines + data.count('\n', pos)
+
+
+class _Span(object):
+    """`count` lines of a MappedFile, starting at line `start`, that haven't
+    been turned into rows yet."""
+
+    def __init__(self, source, start, count):
+        self.source = source
+        self.start = start
+        self.count = count
+
+
+def _weight(item):
+    return item.count if isinstance(item, _Span) else 1
+
+
+class _Leaf(object):
+    def __init__(self, items):
+        self.items = items
+        self.size = sum(_weight(item) for item in items)
+        self.parent = None
+        for item in items:
+            if isinstance(item, Row):
+                item._leaf = self
+
+
+class _Node(object):
+    def __init__(self, children):
+        self.children = children
+        self.size = sum(child.size for child in children)
+        self.parent = None
+        for child in children:
+            child.parent = self
+
+
+class LineBuffer(object):
+    """The rows of a file, kept in a B-tree.
+
+    Leaves hold short lists of rows and every node knows how many rows lie
+    beneath it, so looking up, inserting and deleting a line are O(log n).
+    Line numbers aren't stored on the rows; `index` works a row's number out
+    from its position in the tree. The leaf of the last line looked up is
+    remembered, with the number of its first line, so going to a line near
+    the one before doesn't need the walk down the tree at all, until rows
+    are inserted or deleted.
+
+    A leaf can also hold a span of lines from a MappedFile that haven't
+    been looked at. Such a line only becomes a Row when it is fetched with
+    `[]`; `line` and `lines` read its text without doing so. `fetched`
+    lists the rows made that way, oldest first, so that they can be turned
+    back into lines of the file with `unload`."""
+
+    FANOUT = 64
+
+    def __init__(self, rows=()):
+        rows = list(rows)
+        fanout = self.FANOUT
+        level = [_Leaf(rows[i:i + fanout])
+                 for i in xrange(0, len(rows), fanout)] or [_Leaf([])]
+        while len(level) > 1:
+            level = [_Node(level[i:i + fanout])
+                     for i in xrange(0, len(level), fanout)]
+        self._root = level[0]
+        self._finger = None
+        self.fetched = collections.deque()
+
+    def __len__(self):
+        return self._root.size
+
+    def __iter__(self):
+        return self.iter_from(0)
 
-            if CONFIG['syntax']['flags'] & HL_HIGHLIGHT_STRINGS:
-                if string_delim:
-                    hl[i] = HL_STRING
-                    if c == '\\' and i + 1 < len(self.chars):
-                        hl[i + 1] = HL_STRING
-                        i += 2
-                        continue
-                    if c == string_delim:
-                        string_delim = None
-                    i += 1
-                    prev_sep = 1
+    def __getitem__(self, at):
+        if at < 0 or at >= self._root.size:
+            raise IndexError('row index out of range')
+        leaf, i, offset = self._find(at)
+        item = leaf.items[i]
+        if isinstance(item, _Span):
+            item = self._load(leaf, i, offset)
+        return item
+
+    def __delitem__(self, at):
+        row = self[at]
+        self._finger = None
+        leaf = row._leaf
+        leaf.items.remove(row)
+        row._leaf = None
+        node = leaf
+        while node:
+            node.size -= 1
+            node = node.parent
+
+        node = leaf
+        while not node.size and node.parent:
+            node.parent.children.remove(node)
+            node = node.parent
+        if not self._root.size:
+            self._root = _Leaf([])
+        while isinstance(self._root, _Node) and len(self._root.children) == 1:
+            self._root = self._root.children[0]
+            self._root.parent = None
+
+    def insert(self, at, row):
+        self._insert(at, [row])
+
+    def insert_rows(self, at, rows):
+        """Insert a list of rows before line `at` in one go."""
+        if rows:
+            self._insert(at, rows)
+
+    def insert_lines(self, at, source, start, count):
+        """Insert lines `start` to `start + count` of `source` without
+        loading them."""
+        leaf, i, offset = self._find(at)
+        prev = leaf.items[i - 1] if i and not offset else None
+        if (isinstance(prev, _Span) and prev.source is source and
+                prev.start + prev.count == start):
+            prev.count += count
+            self._finger = None
+            node = leaf
+            while node:
+                node.size += count
+                node = node.parent
+        else:
+            self._insert(at, [_Span(source, start, count)])
+
+    def append(self, row):
+        self.insert(len(self), row)
+
+    def is_loaded(self, at):
+        leaf, i, offset = self._find(at)
+        return isinstance(leaf.items[i], Row)
+
+    def line(self, at):
+        """Return the text of line `at`, loaded or not."""
+        leaf, i, offset = self._find(at)
+        item = leaf.items[i]
+        if isinstance(item, _Span):
+            return item.source.line(item.start + offset)
+        return item.chars
+
+    def lines(self, start=0):
+        """Yield the text of every line from `start` on without loading any
+        of them."""
+        for row, line in self.walk(start):
+            yield line
+
+    def walk(self, start=0):
+        """Yield a (row, text) pair for every line from `start` on, where
+        `row` is None for a line that isn't loaded. The buffer must not be
+        changed until the walk is over."""
+        leaf, i, offset = self._find(start)
+        while leaf:
+            for item in itertools.islice(leaf.items, i, None):
+                if isinstance(item, _Span):
+                    for k in xrange(item.start + offset,
+                                    item.start + item.count):
+                        yield None, item.source.line(k)
+                    offset = 0
+                else:
+                    yield item, item.chars
+            leaf = self._next_leaf(leaf)
+            i = 0
+
+    def rows_at(self, lines):
+        """Yield the row for each of `lines`, a sorted sequence of line
+        numbers, loading the ones that aren't loaded. Walks the leaves once
+        instead of looking every line up from the root, and loads the
+        wanted lines of a span together."""
+        leaf = None
+        j = 0
+        while j < len(lines):
+            k = lines[j]
+            if leaf is None:
+                leaf, i, offset = self._find(k)
+                base = k - offset
+            items = leaf.items
+            while True:
+                if i == len(items):
+                    leaf, i = self._next_leaf(leaf), 0
+                    # Step over the leaves that hold none of the lines.
+                    while k >= base + leaf.size:
+                        base += leaf.size
+                        leaf = self._next_leaf(leaf)
+                    items = leaf.items
+                    continue
+                if leaf.size == len(items):
+                    # A leaf of rows alone has line k that many rows on.
+                    if k - base < len(items) - i:
+                        i += k - base
+                        base = k
+                        item = items[i]
+                        break
+                    base += len(items) - i
+                    i = len(items)
                     continue
+                item = items[i]
+                if isinstance(item, Row):
+                    if k == base:
+                        break
+                    base += 1
+                elif k < base + item.count:
+                    break
                 else:
-                    if c in ('"', "'"):
-                        string_delim = c
-                        hl[i] = HL_STRING
-                        i += 1
-                        continue
-
-            if CONFIG['syntax']['flags'] & HL_HIGHLIGHT_NUMBERS:
-                if (c.isdigit() and (prev_sep or prev_hl == HL_NUMBER)) or (
-                        c == '.' and prev_hl == HL_NUMBER):
-                    hl[i] = HL_NUMBER
-                    i += 1
-                    prev_sep = False
+                    base += item.count
+                i += 1
+            if isinstance(item, Row):
+                yield item
+                base += 1
+                i += 1
+                j += 1
+                continue
+            stop = bisect.bisect_left(lines, base + item.count, j)
+            rows = self._load_many(leaf, i, [at - base for at in
+                                             itertools.islice(lines, j, stop)])
+            for row in rows:
+                yield row
+            leaf = rows[-1]._leaf
+            i = leaf.items.index(rows[-1]) + 1
+            base = lines[stop - 1] + 1
+            j = stop
+
+    def loaded_before(self, at):
+        """Yield (line number, row) for the loaded rows above line `at`,
+        nearest first."""
+        if at <= 0:
+            return
+        leaf, i, offset = self._find(at - 1)
+        end = at - 1 - offset + _weight(leaf.items[i])
+        while leaf:
+            for j in xrange(i, -1, -1):
+                item = leaf.items[j]
+                end -= _weight(item)
+                if isinstance(item, Row):
+                    yield end, item
+            leaf = self._prev_leaf(leaf)
+            if leaf:
+                i = len(leaf.items) - 1
+
+    def snapshot(self):
+        """Return the buffer's text as a list of pieces that stays valid
+        while the buffer is edited: the current string of each loaded row
+        and a (source, start, end) tuple for each run of unloaded lines."""
+        pieces = []
+        leaf = self._find(0)[0]
+        while leaf:
+            for item in leaf.items:
+                if isinstance(item, Row):
+                    pieces.append(item.chars)
                     continue
+                last = pieces[-1] if pieces else None
+                if (isinstance(last, tuple) and last[0] is item.source and
+                        last[2] == item.start):
+                    pieces[-1] = (item.source, last[1],
+                                  item.start + item.count)
+                else:
+                    pieces.append((item.source, item.start,
+                                   item.start + item.count))
+            leaf = self._next_leaf(leaf)
+        return pieces
 
-            if prev_sep:
-                keyword_found = False
-                for key, color in [('keywords1', HL_KEYWORD1),
-                                   ('keywords2', HL_KEYWORD2)]:
-                    for keyword in CONFIG['syntax'][key]:
-                        klen = len(keyword)
-                        if (keyword.startswith(c) and 
-                            self.chars[i:i+klen] == keyword and
-                            is_separtor(self.chars[i + klen])):
-                            hl[i:i+klen] = [color] * klen
-                            i += klen
-                            keyword_found = True
-                            break
-                    else:
-                        continue
+    def loaded(self):
+        """Yield the lines that have been turned into rows."""
+        leaf = self._find(0)[0]
+        while leaf:
+            for item in leaf.items:
+                if isinstance(item, Row):
+                    yield item
+            leaf = self._next_leaf(leaf)
+
+    def unload(self, row, source, k):
+        """Put line `k` of `source` back in place of `row`, which must
+        hold the same text, joining it to the spans either side."""
+        items = row._leaf.items
+        i = items.index(row)
+        prev = items[i - 1] if i else None
+        after = items[i + 1] if i + 1 < len(items) else None
+        if not (isinstance(after, _Span) and after.source is source and
+                after.start == k + 1):
+            after = None
+        if (isinstance(prev, _Span) and prev.source is source and
+                prev.start + prev.count == k):
+            prev.count += 1
+            if after is not None:
+                prev.count += after.count
+                del items[i + 1]
+            del items[i]
+        elif after is not None:
+            after.start -= 1
+            after.count += 1
+            del items[i]
+        else:
+            items[i] = _Span(source, k, 1)
+        row._leaf = None
+
+    def index(self, row):
+        node = row._leaf
+        at = 0
+        for item in node.items:
+            if item is row:
+                break
+            at += _weight(item)
+        while node.parent:
+            for child in node.parent.children:
+                if child is node:
                     break
-                if keyword_found:
-                    prev_sep = False
-                    continue
+                at += child.size
+            node = node.parent
+        return at
 
-            prev_sep = is_separtor(c)
+    def iter_from(self, at):
+        """Yield the rows from line `at` to the end of the file."""
+        for at in xrange(at, len(self)):
+            yield self[at]
+
+    def _find(self, at):
+        """Return the leaf holding line `at`, the index of the item in the
+        leaf that holds it and the line's offset within that item. `at` may
+        be one past the last line, for appending."""
+        finger = self._finger
+        if finger is not None and 0 <= at - finger[1] < finger[0].size:
+            node = finger[0]
+            at -= finger[1]
+        else:
+            node = self._root
+            first = at
+            while isinstance(node, _Node):
+                children = node.children
+                for child in children:
+                    if at < child.size or child is children[-1]:
+                        break
+                    at -= child.size
+                node = child
+            self._finger = node, first - at
+        if at < node.size == len(node.items):
+            # Every item of the leaf is a single row.
+            return node, at, 0
+        for i, item in enumerate(node.items):
+            weight = _weight(item)
+            if at < weight:
+                return node, i, at
+            at -= weight
+        return node, len(node.items), 0
+
+    def _insert(self, at, items):
+        leaf, i, offset = self._find(at)
+        self._finger = None
+        if offset:
+            span = leaf.items[i]
+            leaf.items[i:i + 1] = [
+                _Span(span.source, span.start, offset),
+                _Span(span.source, span.start + offset, span.count - offset)]
             i += 1
+        leaf.items[i:i] = items
+        weight = 0
+        for item in items:
+            if isinstance(item, Row):
+                item._leaf = leaf
+            weight += _weight(item)
+        node = leaf
+        while node:
+            node.size += weight
+            node = node.parent
+        if len(leaf.items) > self.FANOUT:
+            self._split(leaf)
 
-        changed = self.hl_open_comment != in_comment
-        self.hl_open_comment = in_comment
-        if changed and self.idx + 1 < len(CONFIG['row']):
-            pass
-        return hl
+    def _load(self, leaf, i, offset):
+        return self._load_many(leaf, i, [offset])[0]
 
-    @property
-    def chars(self):
-        return self._chars
+    def _load_many(self, leaf, i, offsets):
+        """Turn the lines at `offsets`, in ascending order, of the span that
+        is item `i` of `leaf` into rows, splitting the leaf at most once."""
+        span = leaf.items[i]
+        items = []
+        rows = []
+        at = 0
+        for offset in offsets:
+            if offset > at:
+                items.append(_Span(span.source, span.start + at, offset - at))
+            row = Row(span.source.line(span.start + offset))
+            row._leaf = leaf
+            items.append(row)
+            rows.append(row)
+            self.fetched.append((row, span.source, span.start + offset))
+            at = offset + 1
+        if at < span.count:
+            items.append(_Span(span.source, span.start + at, span.count - at))
+        leaf.items[i:i + 1] = items
+        if len(leaf.items) > self.FANOUT:
+            self._split(leaf)
+        return rows
 
-    @chars.setter
-    def chars(self, chars):
-        self._chars = chars
+    def _next_leaf(self, node):
+        while node.parent:
+            siblings = node.parent.children
+            i = siblings.index(node) + 1
+            if i < len(siblings):
+                node = siblings[i]
+                while isinstance(node, _Node):
+                    node = node.children[0]
+                return node
+            node = node.parent
+        return None
+
+    def _prev_leaf(self, node):
+        while node.parent:
+            siblings = node.parent.children
+            i = siblings.index(node) - 1
+            if i >= 0:
+                node = siblings[i]
+                while isinstance(node, _Node):
+                    node = node.children[-1]
+                return node
+            node = node.parent
+        return None
+
+    def _split(self, node):
+        """Break an overfull node into as few evenly sized siblings as
+        will fit, however many items it has."""
+        parent = node.parent
+        if parent is None:
+            parent = self._root = _Node([node])
+        if isinstance(node, _Leaf):
+            kind, items = _Leaf, node.items
+        else:
+            kind, items = _Node, node.children
+        parts = -(-len(items) // self.FANOUT)
+        size = -(-len(items) // parts)
+        new = [kind(items[i:i + size])
+               for i in xrange(size, len(items), size)]
+        del items[size:]
+        for sibling in new:
+            node.size -= sibling.size
+            sibling.parent = parent
+
+        at = parent.children.index(node) + 1
+        parent.children[at:at] = new
+        if len(parent.children) > self.FANOUT:
+            self._split(parent)
+
+
+class FileWriter(object):
+    """Writes a buffer snapshot (see `LineBuffer.snapshot`) to a file on a
+    worker thread.
+
+    The text is streamed into a temporary file next to the target a chunk
+    at a time, fsynced and renamed over the target, so a failed or
+    interrupted save leaves the old file as it was. `written`, `total`
+    and `rate` can be read from the UI thread while it runs."""
+
+    CHUNK = 1 << 20
+
+    def __init__(self, filename, pieces):
+        self.filename = os.path.realpath(filename)
+        self.pieces = pieces
+        self.total = len(pieces) - 1 if pieces else 0
+        for piece in pieces:
+            if isinstance(piece, tuple):
+                start, end = piece[0].extent(piece[1], piece[2])
+                self.total += end - start
+            else:
+                self.total += len(piece)
+        self.written = 0
+        self.error = None
+        self.done = False
+        self.started = self.finished = None
+        umask = os.umask(0)
+        os.umask(umask)
+        self._mode = 0666 & ~umask
+        self._thread = threading.Thread(target=self._run)
 
     @property
-    def render(self):
-        return self._chars.replace('\t', ' ' * TAB_STOP)
-
-
-CONFIG = {
-    'cx': 0,
-    'cy': 0,
-    'rx': 0,
-    'original_termios': None,
-    'rowoff': 0,
-    'coloff': 0,
-    'screen_rows': 0,
-    'screen_cols': 0,
-    'row': [],
-    'dirty': 0,
-    'filename': None,
-    'status_msg': '',
-    'status_msg_time': 0,
-    'syntax': None,
-    'quit_times': QUIT_TIMES,
-}
+    def rate(self):
+        """Bytes written per second so far."""
+        elapsed = (self.finished or time.time()) - self.started
+        return self.written / elapsed if elapsed > 0 else 0
+
+    def start(self):
+        self.started = time.time()
+        self._thread.start()
+
+    def join(self):
+        self._thread.join()
+
+    def _run(self):
+        try:
+            self._write()
+        except EnvironmentError as e:
+            self.error = e
+        finally:
+            self.finished = time.time()
+            self.done = True
+
+    def _write(self):
+        directory, name = os.path.split(self.filename)
+        fd, tmp = tempfile.mkstemp(prefix='.%s.' % name, suffix='.tmp',
+                                   dir=directory)
+        try:
+            try:
+                mode = stat.S_IMODE(os.stat(self.filename).st_mode)
+            except OSError:
+                mode = self._mode
+            os.fchmod(fd, mode)
+            with os.fdopen(fd, 'wb') as f:
+                self._write_pieces(f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmp, self.filename)
+        except:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+            raise
+        try:
+            dir_fd = os.open(directory, os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(dir_fd)
+        except OSError:
+            pass
+        finally:
+            os.close(dir_fd)
+
+    def _write_pieces(self, f):
+        chunk = []
+        size = 0
+        for i, piece in enumerate(self.pieces):
+            if i:
+                chunk.append('\n')
+                size += 1
+            if isinstance(piece, tuple):
+                self._flush(f, chunk)
+                size = 0
+                source = piece[0]
+                start, end = source.extent(piece[1], piece[2])
+                while start < end:
+                    data = source.read(start, min(start + self.CHUNK, end))
+                    f.write(data)
+                    self.written += len(data)
+                    start += len(data)
+            else:
+                chunk.append(piece)
+                size += len(piece)
+                if size >= self.CHUNK:
+                    self._flush(f, chunk)
+                    size = 0
+        self._flush(f, chunk)
+
+    def _flush(self, f, chunk):
+        data = ''.join(chunk)
+        f.write(data)
+        self.written += len(data)
+        del chunk[:]
+
+
+class Journal(object):
+    """The edits made to a buffer since it was last saved, kept in a file
+    so they can be made again if the editor dies before the next save.
+
+    The file holds a header saying which version of the file the edits go
+    with, then one marshalled record per edit. Records are appended on a
+    worker thread a batch at a time, and the file is fsynced at most every
+    SYNC seconds, so typing never waits on the disk and the cost goes with
+    the number of edits, not the size of the file. A record cut short by a
+    crash is left out when the journal is read back (see `read_journal`)."""
+
+    SYNC = 1.0
+
+    def __init__(self, path, header):
+        self.path = path
+        self.header = header
+        self.records = []
+        self.error = None
+        self._pending = []
+        self._rewrite = True
+        self._closing = False
+        self._discard = False
+        self._synced = 0
+        self._cond = threading.Condition(threading.Lock())
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def extend(self, records):
+        with self._cond:
+            self.records.extend(records)
+            self._pending.extend(records)
+            self._cond.notify()
+
+    def rebase(self, header, count):
+        """Start the file again from `header`, keeping only the records
+        after the first `count`, as when the buffer as it was after those
+        has been saved."""
+        with self._cond:
+            del self.records[:count]
+            self.header = header
+            self._rewrite = True
+            self._cond.notify()
+
+    def close(self, discard=False):
+        """Write out the records still pending and stop, or with `discard`
+        remove the file instead."""
+        with self._cond:
+            self._closing = True
+            self._discard = self._discard or discard
+            self._cond.notify()
+        if self._thread.ident is not None:
+            self._thread.join()
+
+    def _run(self):
+        f = None
+        try:
+            while True:
+                with self._cond:
+                    while not (self._pending or self._rewrite or
+                               self._closing):
+                        self._cond.wait()
+                    rewrite = self._rewrite or f is None
+                    if rewrite:
+                        batch = [self.header] + self.records
+                    else:
+                        batch = self._pending
+                    self._pending = []
+                    self._rewrite = False
+                    closing, discard = self._closing, self._discard
+                if discard or (rewrite and len(batch) == 1):
+                    if f is not None:
+                        f.close()
+                        f = None
+                    self._remove()
+                elif rewrite:
+                    if f is not None:
+                        f.close()
+                    f = self._create(batch)
+                elif batch:
+                    f.write(''.join(marshal.dumps(r) for r in batch))
+                    f.flush()
+                if f is not None and not closing:
+                    # Let the records of the next second or so pile up
+                    # behind this one and go out with the same fsync,
+                    # writing any that come meanwhile as they do.
+                    with self._cond:
+                        wait = self._synced + self.SYNC - time.time()
+                        if wait > 0 and not self._closing:
+                            self._cond.wait(wait)
+                        if ((self._pending or self._rewrite) and
+                                not self._closing and
+                                self._synced + self.SYNC > time.time()):
+                            continue
+                if f is not None:
+                    os.fsync(f.fileno())
+                    self._synced = time.time()
+                if closing:
+                    if f is not None:
+                        f.close()
+                    return
+        except EnvironmentError as e:
+            self.error = e
+
+    def _create(self, records):
+        """Write a new journal file holding `records` in place of the old
+        one, and return it open for appending."""
+        directory = os.path.dirname(self.path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory, 0700)
+        fd, tmp = tempfile.mkstemp(dir=directory)
+        f = os.fdopen(fd, 'wb')
+        try:
+            # Tells another editor opening the file that the journal is
+            # still in use (see `read_journal`). Nothing else can have the
+            # new file open yet, so the lock is there from the start.
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            f.write(''.join(marshal.dumps(r) for r in records))
+            f.flush()
+            os.fsync(f.fileno())
+            if journal_in_use(self.path):
+                raise IOError(errno.EAGAIN, 'another ted is writing %s' %
+                              self.path)
+            os.rename(tmp, self.path)
+        except:
+            f.close()
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+            raise
+        self._synced = time.time()
+        return f
+
+    def _remove(self):
+        if journal_in_use(self.path):
+            # Another editor's, written since this one's was started.
+            return
+        try:
+            os.unlink(self.path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+
+def read_journal(path):
+    """Return the header and records of the journal in `path`, leaving out
+    a last record that was only partly written. Raises IOError with EAGAIN
+    if an editor that is still running is writing the journal."""
+    records = []
+    with open(path, 'rb') as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_SH | fcntl.LOCK_NB)
+        header = marshal.load(f)
+        while True:
+            try:
+                records.append(marshal.load(f))
+            except (EOFError, ValueError, TypeError):
+                return header, records
+
+
+def journal_in_use(path):
+    """Whether an editor that is still running is writing the journal in
+    `path`."""
+    try:
+        with open(path, 'rb') as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_SH | fcntl.LOCK_NB)
+    except IOError as e:
+        return e.errno in (errno.EAGAIN, errno.EWOULDBLOCK)
+    return False
+
+
+class Profiler(object):
+    """Times the phases of the main loop, for finding out where a slow
+    frame went.
+
+    Each phase's time is added up over a frame and kept in a ring buffer of
+    the last SAMPLES frames, so the percentiles cover recent frames only and
+    the memory used stays fixed. A phase timed inside another, as
+    highlighting is while drawing, is taken out of the other's time, so no
+    time is counted twice; 'frame' is the exception, being the whole of
+    the time taken to bring the screen up to date. With `cprofile`,
+    cProfile runs alongside too; it slows every phase down, so it is left
+    off unless asked for."""
+
+    SAMPLES = 1024
+    PHASES = ('read', 'input', 'key', 'scroll', 'highlight', 'draw', 'write',
+              'frame')
+    LABELS = ('rd', 'in', 'key', 'scr', 'hl', 'draw', 'wr', 'frame')
+    TOTALS = ('frame',)
+
+    def __init__(self, cprofile=False):
+        self.frames = 0
+        self.last = None
+        # The time spent in the phases timed inside each phase being timed,
+        # innermost last.
+        self._nested = []
+        self._current = dict.fromkeys(self.PHASES, 0.0)
+        self._samples = dict((phase, array.array('d', [0.0] * self.SAMPLES))
+                             for phase in self.PHASES)
+        self._profile = None
+        if cprofile:
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+
+    def phase(self, name):
+        return _PhaseTimer(self, name)
+
+    def begin(self):
+        self._nested.append(0.0)
+
+    def end(self, name, seconds):
+        """Count `seconds` spent in `name`, less the time of the phases
+        timed inside it."""
+        nested = self._nested.pop()
+        if self._nested:
+            self._nested[-1] += seconds
+        if name not in self.TOTALS:
+            seconds -= nested
+        self._current[name] += seconds
+
+    def end_frame(self):
+        """Record the phases timed since the last frame ended."""
+        at = self.frames % self.SAMPLES
+        for name, seconds in self._current.iteritems():
+            self._samples[name][at] = seconds
+        self.last = self._current
+        self._current = dict.fromkeys(self.PHASES, 0.0)
+        self.frames += 1
+
+    def breakdown(self):
+        """The last frame's phases in milliseconds, for the status bar."""
+        if self.last is None:
+            return ''
+        return ' '.join('%s %.1f' % (label, self.last[name] * 1000)
+                        for name, label in zip(self.PHASES, self.LABELS))
+
+    def stats(self):
+        """Return a table of each phase's times over the recent frames."""
+        count = min(self.frames, self.SAMPLES)
+        lines = ['%d frames, times in ms' % self.frames,
+                 '%-10s %8s %8s %8s %8s %8s' % ('phase', 'mean', 'p50', 'p90',
+                                                'p99', 'max')]
+        for name in self.PHASES:
+            samples = sorted(self._samples[name][:count]) or [0.0]
+            pick = lambda p: samples[min(int(p * len(samples)),
+                                         len(samples) - 1)] * 1000
+            lines.append('%-10s %8.2f %8.2f %8.2f %8.2f %8.2f' % (
+                name, sum(samples) / len(samples) * 1000, pick(0.5),
+                pick(0.9), pick(0.99), samples[-1] * 1000))
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, prefix):
+        """Write the phase table to `prefix`.txt and, if cProfile is
+        running, what it has seen so far to `prefix`.prof, for pstats.
+        Return whether there was a cProfile dump."""
+        with open(prefix + '.txt', 'w') as f:
+            f.write(self.stats())
+        if self._profile is None:
+            return False
+        # dump_stats stops the profiler, so set it going again after.
+        self._profile.dump_stats(prefix + '.prof')
+        self._profile.enable()
+        return True
+
+
+class _PhaseTimer(object):
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.profiler.begin()
+        self.start = time.time()
+
+    def __exit__(self, *exc_info):
+        self.profiler.end(self.name, time.time() - self.start)
+
+
+class _NotTimed(object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+NOT_TIMED = _NotTimed()
+
+
+class Searcher(object):
+    """Finds the lines of a buffer snapshot that match a query, on a worker
+    thread.
+
+    Matching lines are appended to `lines` in file order as they are found,
+    with the bounds of the first match on each in `starts` and `ends`, and
+    `count` keeps the number of matches found in all. When `candidates` is
+    given only those lines are looked at, which is how a search for a
+    longer query narrows down the results for a shorter one."""
+
+    BLOCK = 1 << 20
+
+    def __init__(self, pieces, query, regex=False, candidates=None):
+        self.pieces = pieces
+        self.query = query
+        self.regex = regex
+        self.pattern = re.compile(query) if regex else None
+        self.candidates = candidates
+        self.lines = array.array('L')
+        self.starts = array.array('L')
+        self.ends = array.array('L')
+        self.count = 0
+        self.scanned = 0
+        self.done = False
+        self._stop = False
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def cancel(self):
+        self._stop = True
+
+    def wait(self):
+        self._thread.join()
+
+    def match(self, k):
+        """Return the bounds of the first match on matching line `k`."""
+        i = bisect.bisect_left(self.lines, k)
+        return self.starts[i], self.ends[i]
+
+    def next_line(self, after, direction, timeout=0):
+        """Return the next matching line after line `after` going in
+        `direction`, wrapping around the end of the file. Waits up to
+        `timeout` seconds for the worker to get that far, and returns None
+        if it hasn't or there are no matches."""
+        deadline = time.time() + timeout
+        while True:
+            done = self.done
+            if direction > 0:
+                i = bisect.bisect_right(self.lines, after)
+                if i < len(self.lines):
+                    return self.lines[i]
+            elif self.scanned > after or done:
+                i = bisect.bisect_left(self.lines, after)
+                if i:
+                    return self.lines[i - 1]
+            if done:
+                return self.lines[0 if direction > 0 else -1] if self.lines else None
+            if time.time() >= deadline:
+                return None
+            time.sleep(0.005)
+
+    def _run(self):
+        try:
+            if self.candidates is None:
+                self._scan_pieces()
+            else:
+                self._scan_candidates()
+        finally:
+            self.done = True
+
+    def _found(self, k, line):
+        if self.pattern is not None:
+            matches = [m.span() for m in self.pattern.finditer(line)]
+            if not matches:
+                return
+            start, end = matches[0]
+            count = len(matches)
+        else:
+            start = line.find(self.query)
+            if start == -1:
+                return
+            end = start + len(self.query)
+            count = line.count(self.query)
+        self.starts.append(start)
+        self.ends.append(end)
+        self.count += count
+        self.lines.append(k)
+
+    def _scan_pieces(self):
+        k = 0
+        for i, piece in enumerate(self.pieces):
+            if self._stop:
+                return
+            if isinstance(piece, tuple):
+                source, first, last = piece
+                n = self._scan_mapped(k, source, first, last)
+                if last is None:
+                    # Now that the unindexed tail has been read through,
+                    # record how many lines it has for later searches.
+                    self.pieces[i] = (source, first, first + n)
+                k += n
+            else:
+                self._found(k, piece)
+                k += 1
+                self.scanned = k
+
+    def _scan_mapped(self, k, source, first, last):
+        """Scan a range of mapped lines a block at a time, only splitting out
+        the lines around places where the query could match. Returns the
+        number of lines in the range."""
+        if self.pattern is None:
+            hint = lambda block, pos: block.find(self.query, pos)
+        elif re.search(r'\\[AZ]|\(\?<?[=!]', self.query):
+            # Anchors and lookarounds can behave differently with the
+            # neighbouring lines around, so try every line.
+            hint = lambda block, pos: pos
+        else:
+            pattern = re.compile(self.query, re.MULTILINE)
+            def hint(block, pos):
+                m = pattern.search(block, pos)
+                return m.start() if m else -1
+
+        k0 = k
+        pos, end = source.extent(first, last)
+        while not self._stop:
+            cut = end
+            if pos + self.BLOCK < end:
+                cut = source.rfind('\n', pos, pos + self.BLOCK)
+                if cut < pos:
+                    cut = source.find('\n', pos + self.BLOCK, end)
+                    if cut == -1:
+                        cut = end
+            block = source.read(pos, cut)
+
+            i = 0
+            line = k
+            while i <= len(block):
+                hit = hint(block, i)
+                if hit == -1:
+                    break
+                line += block.count('\n', i, hit)
+                start = block.rfind('\n', 0, hit) + 1
+                i = block.find('\n', hit)
+                if i == -1:
+                    i = len(block)
+                self._found(line, block[start:i])
+                line += 1
+                i += 1
+
+            k += block.count('\n') + 1
+            self.scanned = k
+            if cut >= end:
+                break
+            pos = cut + 1
+        return k - k0
+
+    def _scan_candidates(self):
+        firsts = []
+        k = 0
+        for piece in self.pieces:
+            firsts.append(k)
+            k += piece[2] - piece[1] if isinstance(piece, tuple) else 1
+        for k in self.candidates:
+            if self._stop:
+                return
+            p = bisect.bisect_right(firsts, k) - 1
+            piece = self.pieces[p]
+            if isinstance(piece, tuple):
+                line = piece[0].line(piece[1] + k - firsts[p])
+            else:
+                line = piece
+            self._found(k, line)
+            self.scanned = k + 1
+
+
+class Buffer(object):
+    """An open file. While it is the one showing, its state is in CONFIG;
+    otherwise it is kept in `state`."""
+
+    def __init__(self):
+        self.state = buffer_state()
+        # When the buffer was last shown, to evict the least recently used
+        # first, and roughly how many bytes it holds, once measured.
+        self.used = 0
+        self.size = None
+
+
+def buffer_state():
+    """Return the state of an empty buffer: the keys of CONFIG that each
+    buffer has its own value for."""
+    return {
+        'cx': 0,
+        'cy': 0,
+        'rx': 0,
+        'rowoff': 0,
+        'coloff': 0,
+        'row': LineBuffer(),
+        'edit_row': None,
+        'source': None,
+        'source_lines': 0,
+        'source_at': 0,
+        'writer': None,
+        'writer_dirty': 0,
+        'writer_journal': 0,
+        'journal': None,
+        'journal_off': False,
+        'version': 0,
+        'search': None,
+        'search_version': 0,
+        'search_cache': {},
+        'search_pieces': None,
+        'dirty': 0,
+        'filename': None,
+        'file_id': None,
+        'file_size': 0,
+        'file_mtime': None,
+        'follow': False,
+        'title': None,
+        'hits': None,
+        'syntax': None,
+        'syntax_frontier': 0,
+        'syntax_reached': 0,
+        'syntax_state': None,
+    }
+
+BUFFER_KEYS = tuple(buffer_state())
+
+def editor_state():
+    """Return the state of an editor that has just started: that of its
+    empty buffer, and of the editor as a whole."""
+    state = buffer_state()
+    state.update({
+        'original_termios': None,
+        'screen_rows': 0,
+        'screen_cols': 0,
+        'status_msg': '',
+        'status_msg_time': 0,
+        'syntax_index': None,
+        'syntaxes': {},
+        'quit_times': QUIT_TIMES,
+        'frame': None,
+        'frame_rowoff': 0,
+        'redraw': False,
+        'input': '',
+        'keys': collections.deque(),
+        'recording': None,
+        'macro': None,
+        'replaying': False,
+        'replay_low': None,
+        'replay_records': [],
+        'profiler': None,
+        'signal_pipe': None,
+        'timers': {},
+        'idle_jobs': [],
+        'buffer': None,
+        'buffers': [],
+        'trim': None,
+        'project_search': None,
+        'pipe': None,
+        'reported_size': None,
+        'serving': False,
+    })
+    return state
+
+CONFIG = editor_state()
 
 BACKSPACE = 127
 ARROW_LEFT = 1000
@@ -181,33 +1697,75 @@ HOME_KEY = 1005
 END_KEY = 1006
 PAGE_UP = 1007
 PAGE_DOWN = 1008
+WINDOW_SIZE = 1009
+
+# Control keys that do something.
+CTRL_E = ord('e') & 0x1f
+CTRL_F = ord('f') & 0x1f
+CTRL_G = ord('g') & 0x1f
+CTRL_K = ord('k') & 0x1f
+CTRL_L = ord('l') & 0x1f
+CTRL_N = ord('n') & 0x1f
+CTRL_O = ord('o') & 0x1f
+CTRL_P = ord('p') & 0x1f
+CTRL_Q = ord('q') & 0x1f
+CTRL_R = ord('r') & 0x1f
+CTRL_S = ord('s') & 0x1f
+CTRL_T = ord('t') & 0x1f
+
+# Keys left out of a macro: those that record and play it, and reports
+# from the terminal.
+UNRECORDED_KEYS = (CTRL_K, CTRL_E, WINDOW_SIZE)
+
+ESCAPE_RE = re.compile(r'\x1b(?:\[([0-9;]*)([~A-Za-z])|O([A-Za-z]))')
+ESCAPE_PREFIX_RE = re.compile(r'\x1b(?:\[[0-9;]*|O)?\Z')
+WINDOW_SIZE_RE = re.compile(r'8;([0-9]+);([0-9]+)\Z')
+ESCAPE_KEYS = {
+    '1~': HOME_KEY, '3~': DEL_KEY, '4~': END_KEY, '5~': PAGE_UP,
+    '6~': PAGE_DOWN, '7~': HOME_KEY, '8~': END_KEY,
+    'A': ARROW_UP, 'B': ARROW_DOWN, 'C': ARROW_RIGHT, 'D': ARROW_LEFT,
+    'F': END_KEY, 'H': HOME_KEY,
+}
+PASTE_START = '\x1b[200~'
+PASTE_END = '\x1b[201~'
+
+SEPARATORS = ' ,.()+-/*=~%<>[];'
+CONTROL_RE = re.compile('([\x00-\x1f\x7f])')
 
 HL_HIGHLIGHT_NUMBERS = 1 << 0
 HL_HIGHLIGHT_STRINGS = 1 << 1
 
-HLDB = [
-    {'filetype': 'c',
-     'filematch': ['.c', '.h', '.cpp'],
-     'keywords1': ['switch', 'if', 'while', 'for', 'break', 'continue', 
-                   'return', 'else', 'struct', 'union', 'typedef', 'static',
-                   'enum', 'class', 'case'],
-     'keywords2': ['int', 'long', 'double', 'float', 'char', 'unsigned',
-                   'signed', 'void'],
-     'singleline_comment_start': '//',
-     'multiline_comment_start': '/*',
-     'multiline_comment_end': '*/',
-     'flags': HL_HIGHLIGHT_NUMBERS | HL_HIGHLIGHT_STRINGS,
-    },
-]
+SYNTAX_FLAGS = {
+    'numbers': HL_HIGHLIGHT_NUMBERS,
+    'strings': HL_HIGHLIGHT_STRINGS,
+}
+
+def timed(phase):
+    """Return a context manager that adds the time spent in it to `phase`
+    when profiling, and does nothing otherwise."""
+    profiler = CONFIG['profiler']
+    return profiler.phase(phase) if profiler is not None else NOT_TIMED
 
 def ctrl(key):
     return chr(ord(key) & 0x1f)
 
 def is_separtor(c):
-    return c in " ,.()+-/*=~%<>[];"
+    return c in SEPARATORS
 
 @atexit.register
 def on_exit():
+    editor_close_journals()
+    if CONFIG['project_search'] is not None:
+        CONFIG['project_search'].cancel()
+    if CONFIG['source'] is not None:
+        CONFIG['source'].close()
+    for buffer in CONFIG['buffers']:
+        if buffer.state is not None and buffer.state['source'] is not None:
+            buffer.state['source'].close()
+    if CONFIG['original_termios'] is None:
+        # Never took over a terminal, as when driven by bench.py.
+        return
+    os.write(fd, '\x1b[?2004l')
     os.write(fd, '\x1b[2J')
     os.write(fd, '\x1b[H')
     termios.tcsetattr(fd, termios.TCSAFLUSH, CONFIG['original_termios'])
@@ -215,56 +1773,113 @@ def on_exit():
 def enable_raw_mode(fd):
     CONFIG['original_termios'] = termios.tcgetattr(fd)
     tty.setraw(fd)
+    # Have the terminal bracket pasted text so it arrives as one edit.
+    os.write(fd, '\x1b[?2004h')
 
 def read_key(fd):
+    """Return the next key code, or the text of a bracketed paste as a
+    string. Input is read in bulk and queued, so a burst of keys costs a
+    single read."""
+    keys = CONFIG['keys']
+    while not keys:
+        pending = CONFIG['input']
+        if pending.startswith(PASTE_START):
+            # The rest of the paste is on its way; wait for it.
+            read_input(fd)
+        elif pending:
+            # A lone escape, or the start of a sequence split across
+            # reads. If nothing follows shortly, it was the escape key.
+            if not read_input(fd, ESCAPE_WAIT):
+                keys.append(0x1b)
+                CONFIG['input'] = pending[1:]
+        elif not read_input(fd):
+            return -1
+        with timed('input'):
+            decode_keys()
+    key = keys.popleft()
+    if CONFIG['recording'] is not None and key not in UNRECORDED_KEYS:
+        CONFIG['recording'].append(key)
+    return key
+
+def read_input(fd, timeout=None):
+    """Add whatever input is available to CONFIG['input'], waiting up to
+    `timeout` seconds, or for as long as it takes if None. Returns whether
+    anything was read."""
+    if timeout is not None and not wait_readable([fd], timeout):
+        return False
     try:
-        c = os.read(fd, 1)
+        with timed('read'):
+            data = os.read(fd, INPUT_SIZE)
     except OSError as err:
-        if err.errno == errno.EAGAIN:
-            return -1
+        if err.errno in (errno.EAGAIN, errno.EINTR):
+            return False
+        raise
+    if not data:
+        raise EOFError
+    CONFIG['input'] += data
+    return True
+
+def decode_keys():
+    """Move every complete key in CONFIG['input'] onto CONFIG['keys'],
+    leaving a trailing partial escape sequence or paste behind."""
+    data = CONFIG['input']
+    keys = CONFIG['keys']
+    i = 0
+    while i < len(data):
+        esc = data.find('\x1b', i)
+        if esc < 0:
+            esc = len(data)
+        keys.extend(bytearray(data[i:esc]))
+        i = esc
+        if i == len(data):
+            break
+        if data.startswith(PASTE_START, i):
+            end = data.find(PASTE_END, i)
+            if end < 0:
+                break
+            keys.append(data[i + len(PASTE_START):end])
+            i = end + len(PASTE_END)
+            continue
+        match = ESCAPE_RE.match(data, i)
+        if match is None:
+            if ESCAPE_PREFIX_RE.match(data, i):
+                break
+            keys.append(0x1b)
+            i += 1
+            continue
+        params, final, letter = match.groups()
+        size = final == 't' and WINDOW_SIZE_RE.match(params)
+        if size:
+            # A report of the window's size, as a client attached to the
+            # server sends when its terminal is resized.
+            CONFIG['reported_size'] = dict(zip(('screen_rows', 'screen_cols'),
+                                               map(int, size.groups())))
+            keys.append(WINDOW_SIZE)
+            i = match.end()
+            continue
+        if letter is not None:
+            key = letter
+        elif final == '~':
+            key = params + final
         else:
-            raise
-    if c == '\x1b':
-        try:
-            seq = os.read(fd, 3)
-            if seq[0] == '[':
-                if ord('0') <= ord(seq[1]) <= ord('9'):
-                    if seq[2] == '~':
-                        if seq[1] == '1':
-                            return HOME_KEY
-                        elif seq[1] == '3':
-                            return DEL_KEY
-                        elif seq[1] == '4':
-                            return END_KEY
-                        elif seq[1] == '5':
-                            return PAGE_UP
-                        elif seq[1] == '6':
-                            return PAGE_DOWN
-                        elif seq[1] == '7':
-                            return HOME_KEY
-                        elif seq[1] == '8':
-                            return END_KEY
-                elif seq[1] == 'A':
-                    return ARROW_UP
-                elif seq[1] == 'B':
-                    return ARROW_DOWN
-                elif seq[1] == 'C':
-                    return ARROW_RIGHT
-                elif seq[1] == 'D':
-                    return ARROW_LEFT
-                elif seq[1] == 'F':
-                    return END_KEY
-                elif seq[1] == 'H':
-                    return HOME_KEY
-            elif seq[0] == 'O':
-                if seq[1] == 'F':
-                    return END_KEY
-                elif seq[1] == 'H':
-                    return HOME_KEY
-        except (OSError, IndexError) as err:
-            return 0x1b
-        return 0x1b
-    return ord(c)
+            key = final
+        keys.append(ESCAPE_KEYS.get(key, 0x1b))
+        i = match.end()
+    CONFIG['input'] = data[i:]
+
+def input_pending(fd):
+    """Whether more input is waiting to be handled."""
+    return bool(CONFIG['keys']) or bool(wait_readable([fd], 0))
+
+def wait_readable(fds, timeout=None):
+    """Return those of `fds` that can be read from, waiting up to `timeout`
+    seconds for one to be. A signal cuts the wait short."""
+    try:
+        return select.select(fds, [], [], timeout)[0]
+    except select.error as err:
+        if err.args[0] == errno.EINTR:
+            return []
+        raise
 
 def get_cursor_position(fd):
     os.write(fd, '\x1b[6n')
@@ -273,6 +1888,8 @@ def get_cursor_position(fd):
     return (int(left[2:]), int(right[:2]))
 
 def get_window_size(fd):
+    if CONFIG['reported_size'] is not None:
+        return dict(CONFIG['reported_size'])
     try:
         size = struct.unpack('hh', fcntl.ioctl(fd, termios.TIOCGWINSZ, '1234'))
     except IOError:
@@ -284,146 +1901,1578 @@ def select_sytnax_highlight():
     CONFIG['syntax'] = None
     if CONFIG['filename'] is None:
         return
-    ext = os.path.splitext(CONFIG['filename'])[1]
-    for syntax in HLDB:
-        if ext in syntax['filematch']:
-            CONFIG['syntax'] = syntax
-            return
+    path = syntax_for_name(CONFIG['filename'])
+    if path is None and len(CONFIG['row']):
+        path = syntax_for_shebang(CONFIG['row'].line(0))
+    if path is not None:
+        CONFIG['syntax'] = load_syntax(path)
+    for row in CONFIG['row'].loaded():
+        row.hl = None
+        row.hl_in_comment = None
+    CONFIG['syntax_frontier'] = CONFIG['syntax_reached'] = 0
+    CONFIG['syntax_state'] = None
+
+# Syntax definitions
+#
+# Each language is a JSON file in one of SYNTAX_DIRS, a user's own hiding
+# the built-in one of the same name. Which file goes with which file names,
+# extensions and shebang interpreters is kept in an index in CACHE_DIR, so
+# that finding the syntax of a file reads no definition at all. A
+# definition is only read and compiled when a file needs it, and what it
+# compiles to is cached in CACHE_DIR too.
+
+def syntax_files():
+    """Return the path of every syntax definition, by file name."""
+    files = {}
+    for directory in reversed(SYNTAX_DIRS):
+        try:
+            names = os.listdir(directory)
+        except OSError:
+            continue
+        for name in names:
+            if name.endswith('.json'):
+                files[name] = os.path.join(directory, name)
+    return files
+
+def file_signature(path):
+    st = os.stat(path)
+    return (path, st.st_mtime, st.st_size)
+
+def syntax_index():
+    """Return the index of syntax definitions, rebuilding it only when a
+    definition has been added, removed or changed since it was cached."""
+    index = CONFIG['syntax_index']
+    if index is not None:
+        return index
+    signature = sorted(file_signature(path)
+                       for path in syntax_files().itervalues())
+    cache = os.path.join(CACHE_DIR, 'syntax-index')
+    index = read_cache(cache, signature)
+    if index is None:
+        index = {'filenames': {}, 'filematch': {}, 'interpreters': {}}
+        for path, mtime, size in signature:
+            try:
+                syntax = read_syntax(path)
+            except (IOError, ValueError):
+                continue
+            for key, names in index.iteritems():
+                for name in syntax.get(key, ()):
+                    names.setdefault(name, path)
+        write_cache(cache, signature, index)
+    CONFIG['syntax_index'] = index
+    return index
+
+def syntax_for_name(filename):
+    """Return the definition for `filename` by its name or extension."""
+    index = syntax_index()
+    name = os.path.basename(filename)
+    path = index['filenames'].get(name)
+    if path is None:
+        path = index['filematch'].get(os.path.splitext(name)[1])
+    return path
+
+def syntax_for_shebang(line):
+    """Return the definition for a file starting with `line`, going by the
+    interpreter a #! line names, with or without its version number."""
+    if not line.startswith('#!'):
+        return None
+    words = line[2:].split()
+    if words and os.path.basename(words[0]) == 'env':
+        words = [w for w in words[1:] if not w.startswith('-') and '=' not in w]
+    if not words:
+        return None
+    interpreter = os.path.basename(words[0])
+    interpreters = syntax_index()['interpreters']
+    return (interpreters.get(interpreter) or
+            interpreters.get(interpreter.rstrip('0123456789.')))
+
+def read_syntax(path):
+    with open(path) as f:
+        syntax = json.load(f, object_hook=encode_json)
+    syntax['flags'] = sum(SYNTAX_FLAGS[flag] for flag in syntax.get('flags', ()))
+    syntax.setdefault('keywords1', [])
+    syntax.setdefault('keywords2', [])
+    for key in ('singleline_comment_start', 'multiline_comment_start',
+                'multiline_comment_end'):
+        syntax.setdefault(key, None)
+    return syntax
+
+def encode_json(obj):
+    """Make the strings in a decoded JSON object plain ones, like the rest
+    of the buffer."""
+    def encode(value):
+        if isinstance(value, unicode):
+            return value.encode('utf-8')
+        if isinstance(value, list):
+            return [encode(v) for v in value]
+        return value
+    return dict((encode(k), encode(v)) for k, v in obj.iteritems())
+
+def load_syntax(path):
+    """Return the definition in `path` with its scanner compiled, or None
+    if it can't be read. Each definition is loaded once per session, and
+    worked out into tables once for as long as it stays unchanged."""
+    syntaxes = CONFIG['syntaxes']
+    if path in syntaxes:
+        return syntaxes[path]
+    try:
+        syntax = read_syntax(path)
+        signature = file_signature(path)
+    except (IOError, OSError, ValueError, KeyError) as e:
+        set_status_message("Can't load syntax %s: %s" % (path, e))
+        syntaxes[path] = None
+        return None
+    cache = os.path.join(CACHE_DIR, 'syntax',
+                         os.path.basename(path) + '.cache')
+    tables = read_cache(cache, signature)
+    if tables is None:
+        tables = syntax_tables(syntax)
+        write_cache(cache, signature, tables)
+    syntax['scanner'] = compile_tables(tables)
+    syntaxes[path] = syntax
+    return syntax
+
+def read_cache(path, key):
+    """Return what was cached in `path` under `key`, or None if the cache
+    is missing, unreadable or for something else."""
+    try:
+        with open(path, 'rb') as f:
+            version, cached_key, value = marshal.load(f)
+    except (IOError, EOFError, ValueError, TypeError):
+        return None
+    if version != sys.version or cached_key != key:
+        return None
+    return value
+
+def write_cache(path, key, value):
+    """Cache `value` in `path` under `key`. The cache is only a shortcut,
+    so failing to write it is not an error."""
+    directory = os.path.dirname(path)
+    try:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        tmp_fd, tmp_path = tempfile.mkstemp(dir=directory)
+        with os.fdopen(tmp_fd, 'wb') as f:
+            marshal.dump((sys.version, key, value), f)
+        os.rename(tmp_path, path)
+    except (IOError, OSError, ValueError):
+        pass
+
+# Syntax highlighting
+
+def syntax_tables(syntax):
+    """Work out the tables `row_update_syntax` scans with, with each regex
+    as its pattern and flags, so the tables can be cached and turned into a
+    scanner by `compile_tables` without the definition being read and
+    worked through again.
+
+    Outside comments and strings a line is cut into tokens by one regex:
+    comment and string openers, runs of separators, and runs of word
+    characters. A word that starts on a separator boundary is looked up in
+    a keyword dict, so the cost of a line no longer depends on how many
+    keywords the language has."""
+    slc = syntax['singleline_comment_start']
+    mcs = syntax['multiline_comment_start']
+    mce = syntax['multiline_comment_end']
+    if not (mcs and mce):
+        mcs = mce = None
+    quotes = '"\'' if syntax['flags'] & HL_HIGHLIGHT_STRINGS else ''
+
+    # Characters that may begin a comment or string never join a separator
+    # or word run; they are looked at one at a time instead.
+    special = set(quotes)
+    for delim in (slc, mcs):
+        if delim:
+            special.add(delim[0])
+
+    keywords = {}
+    phrases = []
+    for key, color in [('keywords1', HL_KEYWORD1), ('keywords2', HL_KEYWORD2)]:
+        for keyword in syntax[key]:
+            keywords.setdefault(keyword, color)
+            phrases.append((keyword, color))
+
+    def char_class(chars):
+        return '[%s]' % ''.join(re.escape(c) for c in sorted(chars))
+
+    # A keyword containing separators or comment/string characters can't be
+    # found by looking up a single word, so fall back to trying every
+    # keyword in order, as an alternation, at each separator boundary.
+    keyword_re = None
+    if any(set(k) & (set(SEPARATORS) | special) for k in keywords):
+        groups = []
+        for color in (HL_KEYWORD1, HL_KEYWORD2):
+            words = [re.escape(k) for k, c in phrases if c == color]
+            if words:
+                groups.append('(?P<k%d>%s)' % (color, '|'.join(words)))
+        keyword_re = ('(?:%s)(?=%s|$)' % ('|'.join(groups),
+                                          char_class(SEPARATORS)), 0)
+
+    tokens = []
+    if slc:
+        tokens.append('(?P<slc>%s)' % re.escape(slc))
+    if mcs:
+        # Lua's --[[ must not be taken for its -- comment.
+        mcs_token = '(?P<mcs>%s)' % re.escape(mcs)
+        if slc and mcs.startswith(slc):
+            tokens.insert(0, mcs_token)
+        else:
+            tokens.append(mcs_token)
+    if quotes:
+        tokens.append('(?P<string>%s)' % char_class(quotes))
+    seps = set(SEPARATORS) - special
+    tokens.append('(?P<sep>%s%s)' % (char_class(seps),
+                                     '' if keyword_re else '+'))
+    tokens.append('(?P<word>[^%s]+)' % ''.join(
+        re.escape(c) for c in sorted(set(SEPARATORS) | special)))
+    tokens.append('(?P<other>.)')
+
+    # What decides whether a line ends inside a comment, for scanning
+    # without highlighting. It finds the same comment and string openers the
+    # tokens do, since those start with characters no other token takes in,
+    # unless a keyword contains one.
+    openers = tokens[:len([d for d in (slc, mcs, quotes) if d])]
+    state_re = None
+    if openers and not any(set(k) & special for k in keywords):
+        state_re = ('|'.join(openers), 0)
+
+    return {
+        'token_re': ('|'.join(tokens), re.DOTALL),
+        'state_re': state_re,
+        'number_re': ('[0-9]%s*' % char_class(set('0123456789.') - special),
+                      0),
+        'string_re': dict(
+            (q, (r'(?:[^%s\\]|\\.)*(?:%s|\\?$)' % (q, q), re.DOTALL))
+            for q in quotes),
+        'keywords': keywords,
+        'keyword_re': keyword_re,
+        'mcs': mcs,
+        'mce': mce,
+    }
+
+def compile_tables(tables):
+    """Turn the tables from `syntax_tables` into a scanner."""
+    scanner = dict(tables)
+    for key in ('token_re', 'state_re', 'number_re', 'keyword_re'):
+        if scanner[key] is not None:
+            scanner[key] = re.compile(*scanner[key])
+    scanner['string_re'] = dict((q, re.compile(*regex))
+                                for q, regex in tables['string_re'].iteritems())
+    return scanner
+
+def row_update_syntax(row, in_comment):
+    """Highlight `row` assuming the row above left a comment open when
+    `in_comment` is true. Stores the result in `row.hl` and returns whether
+    the row's own open-comment state changed.
+
+    Only the first SYNTAX_CHUNK characters are given colors; the rest of a
+    longer row is only scanned for where its comments begin and end, and
+    `row_extend_syntax` colors it as it comes into view. Without a quick
+    scanner for that, the whole row is highlighted.
+
+    The rest of a long row being edited isn't scanned at all: its state is
+    left as it was until `editor_flush_row` works it out."""
+    started_in_comment = bool(in_comment)
+    row.hl = array.array('I')
+    row._hl_resume = (0, started_in_comment, True)
+    row._hl_checkpoints = None
+    syntax = CONFIG['syntax']
+    l = len(row)
+    if syntax and syntax['scanner']['state_re'] is None:
+        row_extend_syntax(row, l)
+    else:
+        row_extend_syntax(row, SYNTAX_CHUNK)
+    i, in_comment, prev_sep = row._hl_resume
+    if i < l:
+        if row._chars is not None:
+            in_comment = line_syntax_state(row._chars[i:], in_comment)
+        else:
+            in_comment = row.hl_open_comment
+
+    row.hl_in_comment = started_in_comment
+    in_comment = bool(in_comment)
+    changed = row.hl_open_comment != in_comment
+    row.hl_open_comment = in_comment
+    return changed
+
+def row_extend_syntax(row, end):
+    """Carry on highlighting `row` from where it was left off until at least
+    character `end`, adding to `row.hl`, a SYNTAX_STEP at a time. Where it
+    stopped is kept in `row._hl_resume` as a token boundary to start again
+    from: its position, whether it is inside a comment and whether the
+    character before it is a separator. Where each step started is kept
+    too, with how long `row.hl` was then, in `row._hl_checkpoints`, for
+    `row_changed` to go back to."""
+    hl = row.hl
+    resume = row._hl_resume
+    if resume[0] >= end:
+        return
+    # The row being edited is only put together if it has been already.
+    chars = row._chars
+    l = len(chars) if chars is not None else len(row._gap)
+    while resume[0] < end:
+        i, in_comment, prev_sep = resume
+        if i:
+            if row._hl_checkpoints is None:
+                row._hl_checkpoints = []
+            row._hl_checkpoints.append((len(hl), resume))
+        stop = min(i + SYNTAX_STEP, l)
+        if chars is not None:
+            resume = syntax_scan(chars, 0, i, stop, l, in_comment, prev_sep,
+                                 hl.extend)
+        else:
+            resume = row_scan_window(row, i, stop, l, in_comment, prev_sep,
+                                     hl)
+        if resume[0] >= l:
+            break
+    row._hl_resume = resume
+
+def row_scan_window(row, i, stop, l, in_comment, prev_sep, hl):
+    """Highlight the row being edited from `i` to `stop` as `syntax_scan`
+    does, returning where it stopped. Only a window from `i` to a step past
+    `stop` is put together; should the last token run on to the end of it,
+    or a comment not end in it, the rest of the row is put together after
+    all."""
+    n = len(hl)
+    window = row._gap.slice(i, min(stop + SYNTAX_STEP, l))
+    j, ended_in_comment, ended_sep = syntax_scan(
+        window, i, 0, stop - i, l - i, in_comment, prev_sep, hl.extend)
+    if len(window) < l - i and (j == len(window) or
+                                ended_in_comment and j > len(window)):
+        del hl[n:]
+        window = row._gap.slice(i, l)
+        j, ended_in_comment, ended_sep = syntax_scan(
+            window, i, 0, stop - i, l - i, in_comment, prev_sep, hl.extend)
+    return i + j, ended_in_comment, ended_sep
+
+def syntax_scan(chars, base, i, stop, l, in_comment, prev_sep, mark):
+    """Highlight `chars` from `i` on, stopping at the first token boundary
+    at or after `stop`, with `l` the length of the row from where `chars`
+    starts, which is `base` characters into it. Each run is added as its
+    (start, length, class) triple with `mark`. Returns where it stopped,
+    whether inside a comment and whether after a separator."""
+    if not CONFIG['syntax']:
+        in_comment = False
+        i = l
+    else:
+        scanner = CONFIG['syntax']['scanner']
+        token_match = scanner['token_re'].match
+        keywords = scanner['keywords']
+        keyword_re = scanner['keyword_re']
+        highlight_numbers = CONFIG['syntax']['flags'] & HL_HIGHLIGHT_NUMBERS
+        mce = scanner['mce']
+        in_comment = bool(in_comment and mce)
+
+        while i < stop:
+            if in_comment:
+                j = chars.find(mce, i)
+                if j == -1:
+                    mark((base + i, l - i, HL_MLCOMMENT))
+                    i = l
+                    break
+                j += len(mce)
+                mark((base + i, j - i, HL_MLCOMMENT))
+                in_comment = False
+                prev_sep = True
+                i = j
+                continue
+
+            m = token_match(chars, i)
+            kind = m.lastgroup
+            j = m.end()
+            if kind == 'slc':
+                mark((base + i, l - i, HL_COMMENT))
+                i = l
+                break
+            elif kind == 'mcs':
+                mark((base + i, j - i, HL_MLCOMMENT))
+                in_comment = True
+                i = j
+                continue
+            elif kind == 'string':
+                j = scanner['string_re'][chars[i]].match(chars, j).end()
+                mark((base + i, j - i, HL_STRING))
+                prev_sep = True
+                i = j
+                continue
+
+            if prev_sep and highlight_numbers and chars[i].isdigit():
+                j = scanner['number_re'].match(chars, i).end()
+                mark((base + i, j - i, HL_NUMBER))
+                prev_sep = False
+                i = j
+                continue
+
+            if prev_sep and keyword_re:
+                m = keyword_re.match(chars, i)
+                if m:
+                    j = m.end()
+                    mark((base + i, j - i, int(m.lastgroup[1:])))
+                    prev_sep = False
+                    i = j
+                    continue
+
+            if kind == 'word':
+                color = prev_sep and not keyword_re and keywords.get(chars[i:j])
+                if color and (j == len(chars) or chars[j] in SEPARATORS):
+                    mark((base + i, j - i, color))
+                prev_sep = False
+            else:
+                prev_sep = chars[i] in SEPARATORS
+            i = j
+
+    return i, in_comment, prev_sep
+
+def line_syntax_state(chars, in_comment):
+    """Return whether `chars` ends inside a multi-line comment, given
+    whether it starts inside one. Gives the same answer as
+    `row_update_syntax` without working out any colors."""
+    syntax = CONFIG['syntax']
+    if not syntax or not syntax['scanner']['mce']:
+        return False
+    scanner = syntax['scanner']
+    if scanner['state_re'] is None:
+        row = Row(chars)
+        row_update_syntax(row, in_comment)
+        return row.hl_open_comment
+    state_search = scanner['state_re'].search
+    mce = scanner['mce']
+    i = 0
+    l = len(chars)
+    while i < l:
+        if in_comment:
+            j = chars.find(mce, i)
+            if j == -1:
+                return True
+            i = j + len(mce)
+            in_comment = False
+            continue
+        m = state_search(chars, i)
+        if m is None:
+            return False
+        kind = m.lastgroup
+        if kind == 'slc':
+            return False
+        elif kind == 'mcs':
+            in_comment = True
+            i = m.end()
+        else:
+            i = scanner['string_re'][chars[m.start()]].match(chars,
+                                                           m.end()).end()
+    return in_comment
+
+def editor_syntax_state(at):
+    """Return whether line `at` starts inside a multi-line comment, as
+    near as can be told quickly: the lines in between are scanned from the
+    closest row above whose state is known, looking no more than
+    SYNTAX_CHECKPOINT lines back. With no such row that close, the line
+    that far back is taken to start outside a comment.
+
+    Above `CONFIG['syntax_frontier']` the answer is right; below it, it
+    holds until `editor_scan_syntax` gets there and says otherwise."""
+    syntax = CONFIG['syntax']
+    if at <= 0 or not syntax or not syntax['scanner']['mce']:
+        return False
+    rows = CONFIG['row']
+    start = max(at - SYNTAX_CHECKPOINT, 0)
+    state = False
+    for k, row in rows.loaded_before(at):
+        if k < start:
+            break
+        if row.hl_in_comment is not None:
+            start, state = k + 1, row.hl_open_comment
+            break
+    for chars in itertools.islice(rows.lines(start), at - start):
+        state = line_syntax_state(chars, state)
+    return state
+
+def editor_update_syntax(at):
+    """Highlight row `at`, starting from the state `editor_syntax_state`
+    gives it, so a row can be shown without the file above it having been
+    scanned. If the row's own open-comment state changes, the change is
+    carried down through the rows below that are highlighted already, until
+    a row's state comes out as before; beyond them it is left to
+    `editor_scan_syntax`."""
+    rows = CONFIG['row']
+    changed = row_update_syntax(rows[at], editor_syntax_state(at))
+
+    i = at + 1
+    while (changed and i < len(rows) and rows.is_loaded(i) and
+           rows[i]._hl is not None):
+        changed = row_update_syntax(rows[i], rows[i - 1].hl_open_comment)
+        i += 1
+    if changed:
+        syntax_invalidate(i)
+
+def syntax_invalidate(at):
+    """Note that line `at` may no longer start in the state recorded for
+    it, so the scan has to look at it again.
+
+    The scan keeps two marks. Above `syntax_frontier` every recorded state
+    is right. Up to `syntax_reached` they were right before the change that
+    pulled the frontier back, and no line between the two has changed since.
+    When the scan comes to a row there and finds it starts the way it did,
+    everything down to `syntax_reached` still holds and the scan carries on
+    from there."""
+    if at < CONFIG['syntax_frontier']:
+        if CONFIG['syntax_frontier'] < CONFIG['syntax_reached']:
+            # The old frontier may be a change of its own.
+            CONFIG['syntax_reached'] = CONFIG['syntax_frontier']
+        CONFIG['syntax_frontier'] = at
+        CONFIG['syntax_state'] = None
+    elif at < CONFIG['syntax_reached']:
+        CONFIG['syntax_reached'] = at
+
+def syntax_lines_moved(at, count):
+    """Shift the scan's marks for `count` lines inserted at line `at`, or
+    deleted from there when negative."""
+    for key in ('syntax_frontier', 'syntax_reached'):
+        if CONFIG[key] > at:
+            CONFIG[key] = max(CONFIG[key] + count, at)
+    syntax_invalidate(at)
+
+def editor_scan_syntax(deadline):
+    """Idle job: record which lines start inside a multi-line comment, from
+    `syntax_frontier` down to the end of the file. Loaded rows keep their
+    state; for a mapped file, every SYNTAX_CHECKPOINT-th line is loaded to
+    hold it, so `editor_syntax_state` never has far to look. A highlighted
+    row found to have started in the wrong state is redone. The scan waits
+    at a long row being edited until it is put back together."""
+    syntax = CONFIG['syntax']
+    rows = CONFIG['row']
+    at = CONFIG['syntax_frontier']
+    if at >= len(rows) or not syntax or not syntax['scanner']['mce']:
+        return False
+    stop = len(rows)
+    edit = CONFIG['edit_row']
+    if edit is not None and edit._gap is not None and len(edit) > SYNTAX_CHUNK:
+        stop = edit.idx
+        if at >= stop:
+            return False
+    # The scan's state at the frontier carries over from the last slice,
+    # unless the frontier has been moved since.
+    state = CONFIG['syntax_state']
+    if state is None:
+        state = editor_syntax_state(at)
+    while at < stop:
+        if at % SYNTAX_CHECKPOINT == 0 and not rows.is_loaded(at):
+            rows[at]
+        end = min(at - at % SYNTAX_CHECKPOINT + SYNTAX_CHECKPOINT, stop)
+        for row, chars in itertools.islice(rows.walk(at), end - at):
+            if row is None:
+                state = line_syntax_state(chars, state)
+            elif row.hl_in_comment == state:
+                if at < CONFIG['syntax_reached']:
+                    # Nothing below here has changed; skip to where it has.
+                    CONFIG['syntax_frontier'] = CONFIG['syntax_reached']
+                    CONFIG['syntax_state'] = None
+                    return True
+                state = row.hl_open_comment
+            else:
+                row.hl_in_comment = state
+                state = row.hl_open_comment = line_syntax_state(chars, state)
+                if row._hl is not None:
+                    row._hl = None
+                    CONFIG['redraw'] = True
+            at += 1
+            if time.time() >= deadline:
+                break
+        CONFIG['syntax_frontier'] = at
+        CONFIG['syntax_reached'] = max(CONFIG['syntax_reached'], at)
+        CONFIG['syntax_state'] = state
+        if time.time() >= deadline:
+            break
+    return at < stop
+
+# row operations
+
+def row_update_render(row):
+    """Expand the tabs in `row` to tab stops, and record where each tab is
+    and the render column it ends at in `row._tabs`; the columns of the
+    other characters follow from those. A row without tabs renders as it is
+    and gets no tab map."""
+    chars = row.chars
+    if '\t' not in chars:
+        row._render = chars
+        row._tabs = None
+        return
+    row._render, tabs, ends = expand_tabs(chars)
+    row._tabs = tabs, ends
+
+def expand_tabs(chars, col=0):
+    """Return `chars`, starting at render column `col`, with its tabs
+    expanded, and the positions of the tabs and the columns they end at."""
+    tabs = array.array('I')
+    ends = array.array('I')
+    parts = []
+    at = 0
+    for i, part in enumerate(chars.split('\t')):
+        if i:
+            width = TAB_STOP - col % TAB_STOP
+            parts.append(' ' * width)
+            tabs.append(at)
+            at += 1
+            col += width
+            ends.append(col)
+        parts.append(part)
+        at += len(part)
+        col += len(part)
+    return ''.join(parts), tabs, ends
+
+def hl_runs(hl, start, end):
+    """Yield (start, end, class) for each run of one class between `start`
+    and `end`, filling the gaps between the runs in `hl` with HL_NORMAL.
+    The first run is found by bisection, so only the runs in between are
+    looked at."""
+    # The runs don't overlap, so their ends are in order too.
+    lo, hi = 0, len(hl) // 3
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if hl[3 * mid] + hl[3 * mid + 1] <= start:
+            lo = mid + 1
+        else:
+            hi = mid
+    at = start
+    for k in xrange(3 * lo, len(hl), 3):
+        run_start = hl[k]
+        run_end = run_start + hl[k + 1]
+        if run_end <= at:
+            continue
+        if run_start >= end:
+            break
+        if run_start > at:
+            yield at, run_start, HL_NORMAL
+            at = run_start
+        yield at, min(run_end, end), hl[k + 2]
+        at = run_end
+    if at < end:
+        yield at, end, HL_NORMAL
+
+def hl_overlay(hl, start, length, cls):
+    """Return a copy of `hl` with `length` characters from `start` marked
+    as `cls`, over whatever they were before."""
+    end = start + length
+    runs = [(start, length, cls)]
+    for k in xrange(0, len(hl), 3):
+        run_start = hl[k]
+        run_end = run_start + hl[k + 1]
+        if run_start < start:
+            runs.append((run_start, min(run_end, start) - run_start, hl[k + 2]))
+        if run_end > end:
+            run_start = max(run_start, end)
+            runs.append((run_start, run_end - run_start, hl[k + 2]))
+    runs.sort()
+    return array.array('I', itertools.chain.from_iterable(runs))
+
+def row_cx_to_rx(row, cx):
+    if row._gap is not None:
+        return row._gap.column(cx) if row._gap.has_tabs() else cx
+    if row.tabs is None:
+        return cx
+    tabs, ends = row.tabs
+    i = bisect.bisect_left(tabs, cx)
+    if not i:
+        return cx
+    return ends[i - 1] + cx - tabs[i - 1] - 1
+
+def row_column(row, rx):
+    """Return the character that render column `rx` of `row` shows, or
+    where it would be past the end of the row."""
+    if row._gap is not None:
+        return row._gap.index(rx) if row._gap.has_tabs() else rx
+    if row.tabs is None:
+        return rx
+    tabs, ends = row.tabs
+    i = bisect.bisect_right(ends, rx)
+    if not i:
+        cx = rx
+    else:
+        cx = tabs[i - 1] + 1 + rx - ends[i - 1]
+    if i < len(tabs):
+        cx = min(cx, tabs[i])
+    return cx
+
+def row_delete(at):
+    rows = CONFIG['row']
+    if at < 0 or at >= len(rows):
+        return
+    del rows[at]
+    CONFIG['version'] += 1
+    if at < len(rows) and rows.is_loaded(at):
+        # The row now below `at - 1` was highlighted against the deleted row.
+        rows[at].hl = None
+    syntax_lines_moved(at, -1)
+    if at < CONFIG['source_at']:
+        CONFIG['source_at'] -= 1
+    CONFIG['dirty'] += 1
+
+def row_edit_buffer(row):
+    """Return the gap buffer holding `row`'s characters, moving them into
+    one if the row isn't the one being edited yet. Callers must call
+    `row_changed` once they have modified it."""
+    if row._gap is None:
+        editor_flush_row()
+        row._gap = GapBuffer(row.chars, row.tabs)
+        CONFIG['edit_row'] = row
+    return row._gap
+
+def row_changed(row, at):
+    """Note that `row` was changed from character `at` on. A long row being
+    edited keeps its highlighting up to a checkpoint short of `at` and
+    carries on from there, without its open-comment state being redone until
+    it is put back together."""
+    row._chars = None
+    row._render = None
+    if (row._gap is not None and len(row._gap) > SYNTAX_CHUNK and
+            row._hl is not None):
+        row_rewind_syntax(row, at - SYNTAX_LOOKBEHIND)
+    else:
+        row._hl = None
+        row.hl_in_comment = None
+    CONFIG['version'] += 1
+    if CONFIG['replaying']:
+        # The keys of a macro edit the line the cursor is on, or the one
+        # above when they join the two.
+        low = CONFIG['replay_low']
+        if low is None or CONFIG['cy'] - 1 < low:
+            CONFIG['replay_low'] = max(CONFIG['cy'] - 1, 0)
+    else:
+        syntax_invalidate(row.idx)
+
+def row_rewind_syntax(row, at):
+    """Drop the highlighting of `row` after the last checkpoint before
+    character `at`, to be carried on from there."""
+    checkpoints = row._hl_checkpoints
+    while checkpoints and checkpoints[-1][1][0] > at:
+        checkpoints.pop()
+    if checkpoints:
+        n, row._hl_resume = checkpoints[-1]
+        # The checkpoint comes back when the highlighting is carried on.
+        checkpoints.pop()
+    else:
+        n = 0
+        row._hl_resume = (0, row.hl_in_comment, True)
+    del row._hl[n:]
+
+def row_insert_char(row, at, c):
+    gap = row_edit_buffer(row)
+    at = min(at, len(gap))
+    gap.insert(at, c)
+    row_changed(row, at)
+    CONFIG['dirty'] += 1
+
+def row_delete_char(row, at):
+    if at < 0 or at >= len(row):
+        return
+    row_edit_buffer(row).delete(at)
+    row_changed(row, at)
+    CONFIG['dirty'] += 1
+
+# Editor Operations
+def editor_insert_row(at, s):
+    editor_insert_rows(at, [s])
+
+def editor_insert_rows(at, lines):
+    rows = CONFIG['row']
+    new = [Row(s) for s in lines]
+    # Start from the state the row below was highlighted against, so the
+    # new rows' first highlight only propagates if it really changes it.
+    open_comment = (at > 0 and rows.is_loaded(at - 1) and
+                    rows[at - 1].hl_open_comment)
+    for row in new:
+        row.hl_open_comment = open_comment
+    rows.insert_rows(at, new)
+    CONFIG['version'] += 1
+    syntax_lines_moved(at, len(new))
+    if at <= CONFIG['source_at']:
+        CONFIG['source_at'] += len(new)
+
+def editor_flush_row():
+    """Turn the row being edited back into a plain string, and work out
+    whether a long one now ends inside a comment, which was left alone
+    while it was edited."""
+    row = CONFIG['edit_row']
+    if row is not None and row._gap is not None:
+        long_row = len(row._gap) > SYNTAX_CHUNK
+        row._chars = row.chars
+        row._gap = None
+        if (long_row and row._leaf is not None and
+                row.hl_in_comment is not None):
+            state = bool(line_syntax_state(row._chars, row.hl_in_comment))
+            if state != row.hl_open_comment:
+                row.hl_open_comment = state
+                syntax_invalidate(row.idx + 1)
+    CONFIG['edit_row'] = None
+
+def editor_read_only():
+    """Whether the buffer can't be changed just now, saying why if so."""
+    if CONFIG['follow']:
+        set_status_message('Following the file; Ctrl-T to stop')
+        return True
+    if CONFIG['hits'] is not None:
+        set_status_message('Search results; Enter opens the file of a match')
+        return True
+    return False
+
+def editor_insert_char(c):
+    if editor_read_only():
+        return
+    editor_journal('c', c)
+    if CONFIG['cy'] == len(CONFIG['row']):
+        editor_insert_row(CONFIG['cy'], '')
+    row_insert_char(CONFIG['row'][CONFIG['cy']], CONFIG['cx'], c)
+    CONFIG['cx'] += 1
+    CONFIG['dirty'] += 1
+
+def editor_insert_newline():
+    if editor_read_only():
+        return
+    editor_journal('n')
+    if CONFIG['cx'] == 0:
+        editor_insert_row(CONFIG['cy'], '')
+        # CONFIG['row'].insert(CONFIG['cy'], Row('', CONFIG['cy']))
+    else:
+        row = CONFIG['row'][CONFIG['cy']]
+        # CONFIG['row'].insert(CONFIG['cy'] + 1, Row(row.chars[CONFIG['cx']:],
+        #CONFIG['cy']))
+        gap = row_edit_buffer(row)
+        tail = gap.slice(CONFIG['cx'], len(gap))
+        gap.delete(CONFIG['cx'], len(tail))
+        row_changed(row, CONFIG['cx'])
+        editor_insert_row(CONFIG['cy'] + 1, tail)
+    CONFIG['cy'] += 1
+    CONFIG['cx'] = 0
+    CONFIG['dirty'] += 1
+
+def editor_insert_text(text):
+    """Insert `text` at the cursor as a single edit, leaving the cursor
+    after it."""
+    if editor_read_only():
+        return
+    if not text:
+        return
+    editor_journal('t', text)
+    lines = text.replace('\r\n', '\n').replace('\r', '\n').split('\n')
+    if CONFIG['cy'] == len(CONFIG['row']):
+        # Past the last line, leading newlines add empty rows just as
+        # typing them does, and anything after starts a new row.
+        while len(lines) > 1 and not lines[0]:
+            editor_insert_row(CONFIG['cy'], '')
+            CONFIG['cy'] += 1
+            del lines[0]
+        if lines == ['']:
+            CONFIG['dirty'] += 1
+            return
+        editor_insert_row(CONFIG['cy'], '')
+    row = CONFIG['row'][CONFIG['cy']]
+    gap = row_edit_buffer(row)
+    cx = min(CONFIG['cx'], len(gap))
+    if len(lines) > 1:
+        tail = gap.slice(cx, len(gap))
+        gap.delete(cx, len(tail))
+        CONFIG['cx'] = len(lines[-1])
+        lines[-1] += tail
+    else:
+        CONFIG['cx'] = cx + len(lines[0])
+    gap.insert(cx, lines[0])
+    row_changed(row, cx)
+    editor_insert_rows(CONFIG['cy'] + 1, lines[1:])
+    CONFIG['cy'] += len(lines) - 1
+    CONFIG['dirty'] += 1
+
+def editor_delete_char():
+    if editor_read_only():
+        return
+    if CONFIG['cy'] == len(CONFIG['row']):
+        return
+    if CONFIG['cx'] == 0 and CONFIG['cy'] == 0:
+        return
+    editor_journal('d')
+    row = CONFIG['row'][CONFIG['cy']]
+    if CONFIG['cx']:
+        row_delete_char(row, CONFIG['cx'] - 1)
+        CONFIG['cx'] -= 1
+    else:
+        prev = CONFIG['row'][CONFIG['cy'] - 1]
+        CONFIG['cx'] = len(prev)
+        row_edit_buffer(prev).insert(CONFIG['cx'], row.chars)
+        row_changed(prev, CONFIG['cx'])
+        CONFIG['dirty'] += 1
+        row_delete(CONFIG['cy'])
+        CONFIG['cy'] -= 1
+
+# File I/O
+
+def editor_open(filename):
+    CONFIG['filename'] = filename
+
+    if os.path.getsize(filename) >= LARGE_FILE_SIZE:
+        editor_open_mapped(filename, copy=CONFIG['follow'])
+        # The first line is needed to tell the syntax by a #! line.
+        select_sytnax_highlight()
+        return
+
+    f = open(filename, 'r')
+    try:
+        rows = []
+        line = None
+        for line in f:
+            if line and line[-1] in ('\r', '\n'):
+                rows.append(Row(line[:-1]))
+            else:
+                rows.append(Row(line))
+        else:
+            if line and line[-1] in ('\r', '\n'):
+                rows.append(Row(''))
+        CONFIG['row'] = LineBuffer(rows)
+        editor_note_file(os.fstat(f.fileno()))
+        CONFIG['file_size'] = f.tell()
+        CONFIG['version'] += 1
+        CONFIG['edit_row'] = None
+        CONFIG['source'] = None
+        CONFIG['source_lines'] = CONFIG['source_at'] = 0
+        CONFIG['syntax_frontier'] = CONFIG['syntax_reached'] = 0
+        CONFIG['syntax_state'] = None
+        CONFIG['dirty'] = 0
+    finally:
+        f.close()
+    select_sytnax_highlight()
+
+def editor_open_mapped(filename, copy=False):
+    """Open a large file without reading it through. Lines stay in a memory
+    map until they are shown or edited, and the map is indexed in the
+    background while the first screen is up.
+
+    With `copy`, the file is copied in the background instead (see
+    PipeFile), for a file being followed: a log truncated in place, as
+    logrotate's copytruncate does, would take the pages of a map out from
+    under the editor and kill it with SIGBUS when they are next read."""
+    if copy:
+        fd = os.open(filename, os.O_RDONLY)
+        st = os.fstat(fd)
+        source = PipeFile(fd, limit=st.st_size)
+        source.start()
+    else:
+        source = MappedFile(filename)
+        st = source.stat
+    source.index_until(CONFIG['screen_rows'])
+    CONFIG['row'] = LineBuffer()
+    editor_note_file(st)
+    CONFIG['file_size'] = st.st_size
+    CONFIG['version'] += 1
+    CONFIG['edit_row'] = None
+    CONFIG['source'] = source
+    CONFIG['source_lines'] = 0
+    CONFIG['source_at'] = 0
+    CONFIG['syntax_frontier'] = CONFIG['syntax_reached'] = 0
+    CONFIG['syntax_state'] = None
+    editor_load_source()
+    if not copy:
+        source.start()
+    CONFIG['dirty'] = 0
+
+def editor_close_source():
+    """Stop reading the buffer's mapped file and let go of it, once the
+    searches reading it have stopped too."""
+    source = CONFIG['source']
+    if source is None:
+        return
+    for search in CONFIG['search_cache'].itervalues():
+        search.cancel()
+        search.wait()
+    CONFIG['search_cache'] = {}
+    CONFIG['search_pieces'] = None
+    CONFIG['search'] = None
+    CONFIG['source'] = None
+    source.close()
+
+def editor_open_pipe(fd):
+    """Show what comes in on the pipe `fd` in a buffer of its own, line by
+    line as it arrives."""
+    previous = editor_current_buffer()
+    buffer = Buffer()
+    CONFIG['buffers'].append(buffer)
+    editor_switch_buffer(buffer)
+    CONFIG['title'] = '[stdin]'
+    CONFIG['source'] = source = PipeFile(fd)
+    source.start()
+    if buffer_is_blank(previous):
+        CONFIG['buffers'].remove(previous)
+    CONFIG['pipe'] = buffer, source
+    editor_poll_pipe()
+
+def editor_poll_pipe():
+    """Timer: wait for the pipe to be read to the end, and say so if that
+    was a read error rather than the end of the input."""
+    buffer, source = CONFIG['pipe']
+    if not source.done:
+        add_timer('pipe', PROGRESS_INTERVAL, editor_poll_pipe)
+        return
+    CONFIG['pipe'] = None
+    if source.error is not None:
+        state = CONFIG if buffer is CONFIG['buffer'] else buffer.state
+        state['title'] = '[stdin, cut short]'
+        set_status_message('stdin: read error, the rest of it is missing: %s'
+                           % source.error)
+
+def editor_note_file(st):
+    """Record which file, as `os.stat` gives it in `st`, the buffer holds."""
+    CONFIG['file_id'] = (st.st_dev, st.st_ino)
+    CONFIG['file_size'] = st.st_size
+    CONFIG['file_mtime'] = st.st_mtime
+
+def editor_file_changed():
+    """Whether the file has been changed or replaced since the buffer was
+    read from it or saved to it."""
+    try:
+        st = os.stat(CONFIG['filename'])
+    except OSError:
+        return False
+    return ((st.st_dev, st.st_ino) != CONFIG['file_id'] or
+            st.st_size != CONFIG['file_size'] or
+            st.st_mtime != CONFIG['file_mtime'])
+
+def editor_load_source():
+    """Add the lines of the mapped file indexed since the last call."""
+    source = CONFIG['source']
+    if source is None:
+        return
+    lines = source.lines
+    count = lines - CONFIG['source_lines']
+    if count > 0:
+        CONFIG['row'].insert_lines(CONFIG['source_at'], source,
+                                   CONFIG['source_lines'], count)
+        CONFIG['source_at'] += count
+        CONFIG['source_lines'] = lines
+
+def editor_load_until(at):
+    """Make sure line `at` is in the buffer, indexing the mapped file as far
+    as that takes."""
+    source = CONFIG['source']
+    missing = at + 1 - len(CONFIG['row'])
+    if source is not None and missing > 0:
+        source.index_until(CONFIG['source_lines'] + missing)
+        editor_load_source()
+
+def editor_snapshot():
+    """Return a snapshot of the whole buffer (see `LineBuffer.snapshot`),
+    including the lines of a mapped file that haven't been indexed yet."""
+    editor_load_source()
+    pieces = CONFIG['row'].snapshot()
+    source = CONFIG['source']
+    if source is not None and CONFIG['source_lines'] <= source.newlines:
+        # The lines that haven't been indexed go straight from the map,
+        # after the last of the file's lines that has.
+        at = 0
+        for i, piece in enumerate(pieces):
+            if at == CONFIG['source_at']:
+                break
+            at += piece[2] - piece[1] if isinstance(piece, tuple) else 1
+        else:
+            i = len(pieces)
+        pieces.insert(i, (source, CONFIG['source_lines'], None))
+    return pieces
+
+def editor_save(fd):
+    if editor_read_only():
+        return
+    if not CONFIG['filename']:
+        CONFIG['filename'] = editor_prompt(fd, 'Save as : %s')
+        if CONFIG['filename'] is None:
+            set_status_message('Save aborted')
+            return
+        select_sytnax_highlight()
+    if CONFIG['writer'] is not None:
+        set_status_message('Already saving, try again when it has finished')
+        return
+
+    writer = FileWriter(CONFIG['filename'], editor_snapshot())
+    CONFIG['writer'] = writer
+    CONFIG['writer_dirty'] = CONFIG['dirty']
+    CONFIG['writer_journal'] = (len(CONFIG['journal'].records)
+                                if CONFIG['journal'] is not None else 0)
+    writer.start()
+    if writer.total < BACKGROUND_SAVE_SIZE:
+        writer.join()
+    editor_poll_writer()
+
+def editor_poll_writer():
+    """Report on the save in progress, and finish it off once the writer
+    is done."""
+    writer = CONFIG['writer']
+    if writer is None:
+        return
+    if not writer.done:
+        set_status_message('Saving... %d%% (%d of %d bytes, %.1f MB/s)' % (
+            100 * writer.written // max(writer.total, 1), writer.written,
+            writer.total, writer.rate / (1024 * 1024)))
+        return
+    CONFIG['writer'] = None
+    if writer.error is not None:
+        set_status_message("Can't save! I/O error: %s" % writer.error)
+        return
+    # Edits made while the file was being written are still unsaved.
+    CONFIG['dirty'] -= CONFIG['writer_dirty']
+    try:
+        editor_note_file(os.stat(CONFIG['filename']))
+    except OSError:
+        pass
+    if CONFIG['journal'] is not None:
+        CONFIG['journal'].rebase(editor_journal_header(),
+                                 CONFIG['writer_journal'])
+    set_status_message('%d bytes written to disk in %.2fs (%.1f MB/s)' % (
+        writer.written, writer.finished - writer.started,
+        writer.rate / (1024 * 1024)))
+
+# Recovery
+#
+# Every edit is noted in a journal for its file (see `Journal`) until the
+# file is saved. When the editor dies with edits unsaved, the journal is
+# left behind, and opening the file again makes the same edits again.
+
+def journal_path(filename):
+    return os.path.join(JOURNAL_DIR, hashlib.sha1(
+        os.path.realpath(filename)).hexdigest())
+
+def editor_journal_header():
+    """Return what a journal of the buffer's edits has to start with: the
+    file, as it was when read or last saved, that they were made to."""
+    return (os.path.realpath(CONFIG['filename']), CONFIG['file_size'],
+            CONFIG['file_mtime'])
+
+def editor_journal(op, *args):
+    """Note the edit `op` with `args` that is about to be made at the
+    cursor in the buffer's journal, starting one on the first edit."""
+    record = (op, CONFIG['cy'], CONFIG['cx']) + args
+    if CONFIG['replaying']:
+        # A macro's edits go to the journal together when it stops.
+        CONFIG['replay_records'].append(record)
+    else:
+        editor_journal_records([record])
+
+def editor_journal_records(records):
+    """Add `records` to the buffer's journal, starting it if need be."""
+    journal = CONFIG['journal']
+    if journal is not None and journal.error is not None:
+        # The journal has stopped being written, so the edits from here on
+        # aren't kept anywhere; there's no use holding on to them.
+        set_status_message("Can't keep unsaved edits! I/O error: %s" %
+                           journal.error)
+        journal.close()
+        CONFIG['journal'] = None
+        CONFIG['journal_off'] = True
+    elif journal is not None:
+        journal.extend(records)
+    elif CONFIG['file_id'] is not None and not CONFIG['journal_off']:
+        path = journal_path(CONFIG['filename'])
+        if journal_in_use(path):
+            # Writing a journal of our own in its place would leave the
+            # other editor's edits with none.
+            CONFIG['journal_off'] = True
+            set_status_message('Another ted is editing %s; unsaved edits '
+                               'made here are not being kept' %
+                               CONFIG['filename'])
+            return
+        journal = CONFIG['journal'] = Journal(path, editor_journal_header())
+        journal.extend(records)
+        journal.start()
+
+def editor_recover():
+    """Make the edits left unsaved in the buffer's file by a session that
+    didn't end properly again, if the file hasn't changed since."""
+    path = journal_path(CONFIG['filename'])
+    try:
+        header, records = read_journal(path)
+    except IOError as e:
+        if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+            set_status_message('The unsaved edits to %s belong to another '
+                               'ted that is still running' %
+                               CONFIG['filename'])
+        return
+    except (OSError, EOFError, ValueError, TypeError):
+        return
+    if header != editor_journal_header():
+        set_status_message('%s has changed since the unsaved edits in %s '
+                           'were made; not recovering them' % (
+                               CONFIG['filename'], path))
+        return
+    if not records:
+        return
+    ops = {
+        'c': editor_insert_char,
+        'n': editor_insert_newline,
+        't': editor_insert_text,
+        'd': editor_delete_char,
+        'r': editor_replace_all,
+    }
+    # The edits go into a journal that isn't written until they have all
+    # been made, so the old one stays whole until then.
+    journal = CONFIG['journal'] = Journal(path, header)
+    for record in records:
+        op, cy, cx = record[:3]
+        editor_load_until(cy)
+        CONFIG['cy'], CONFIG['cx'] = cy, cx
+        ops[op](*record[3:])
+    journal.start()
+    set_status_message('Recovered %d unsaved edits; Ctrl-S to keep them' %
+                       len(records))
+
+def editor_close_journals(discard=False):
+    """Stop the journals of all buffers, removing their files if
+    `discard`."""
+    journals = [CONFIG['journal']]
+    for buffer in CONFIG['buffers']:
+        if buffer.state is not None:
+            journals.append(buffer.state['journal'])
+    for journal in journals:
+        if journal is not None:
+            journal.close(discard)
+
+# Following
+
+def editor_toggle_follow():
+    """Start or stop following the file, the way `tail -f` does."""
+    if CONFIG['follow']:
+        CONFIG['follow'] = False
+        set_status_message('Stopped following')
+        return
+    if CONFIG['file_id'] is None:
+        set_status_message('Only a file that was opened can be followed')
+        return
+    if CONFIG['dirty']:
+        set_status_message('Save or discard the changes to follow the file')
+        return
+    CONFIG['follow'] = True
+    if type(CONFIG['source']) is MappedFile:
+        # Read it again as a copy (see `editor_open_mapped`).
+        editor_reload()
+    set_status_message('Following the file; Ctrl-T to stop')
+    editor_follow()
+
+def editor_follow():
+    """Timer: bring a followed buffer up to date with its file. Only the
+    bytes added since the last look are read, a chunk at a time. A file
+    that was replaced or truncated is read again from the start.
+
+    With the cursor on the last line, it is kept there, so the new lines
+    scroll into view."""
+    if not CONFIG['follow']:
+        return
+    add_timer('follow', FOLLOW_INTERVAL, editor_follow)
+    try:
+        st = os.stat(CONFIG['filename'])
+    except OSError:
+        # Rotated away, and not yet replaced.
+        return
+    rows = CONFIG['row']
+    at_end = CONFIG['cy'] >= len(rows) - 1
+    source = CONFIG['source']
+    if ((st.st_dev, st.st_ino) != CONFIG['file_id'] or
+            st.st_size < CONFIG['file_size']):
+        if not editor_reload():
+            return
+        rows = CONFIG['row']
+        CONFIG['cy'] = min(CONFIG['cy'], max(len(rows) - 1, 0))
+        CONFIG['cx'] = 0
+        set_status_message('The file was replaced or truncated; reread it')
+    elif source is not None and not (source.done and
+                                     CONFIG['source_lines'] == source.lines):
+        # A large file is still being copied, so its last line isn't the
+        # last row yet.
+        editor_load_source()
+        return
+    elif st.st_size > CONFIG['file_size']:
+        try:
+            with open(CONFIG['filename'], 'rb') as f:
+                f.seek(CONFIG['file_size'])
+                data = f.read(min(st.st_size - CONFIG['file_size'],
+                                  FOLLOW_CHUNK))
+        except IOError:
+            return
+        CONFIG['file_size'] += len(data)
+        editor_append(data)
+        if CONFIG['file_size'] < st.st_size:
+            add_timer('follow', 0, editor_follow)
+    else:
+        return
+    if at_end:
+        CONFIG['cy'] = max(len(rows) - 1, 0)
+        CONFIG['cx'] = 0
 
-# row operations
+def editor_append(data):
+    """Add `data` read from the end of the file to the end of the buffer,
+    the first of its lines continuing the last row."""
+    rows = CONFIG['row']
+    lines = data.split('\n')
+    if len(rows):
+        row = rows[len(rows) - 1]
+        gap = row_edit_buffer(row)
+        at = len(gap)
+        gap.insert(at, lines.pop(0))
+        row_changed(row, at)
+    editor_insert_rows(len(rows), lines)
 
-def row_cx_to_rx(row, cx):
-    rx = 0
-    for i in xrange(cx):
-        if row.chars[i] == '\t':
-            rx += (TAB_STOP - 1) - (rx % TAB_STOP)
-        rx += 1
-    return rx
-
-def row_rx_to_cx(row, rx):
-    cur_rx = 0
-    for cx, c in enumerate(row.chars):
-        if c == '\t':
-            cur_rx += (TAB_STOP - 1) - (cur_rx % TAB_STOP)
-        cur_rx += 1
-
-        if cur_rx > rx:
-            return cx
-    return cx
+# Buffers
 
-def row_delete(at):
-    rows = CONFIG['row']
-    if at < 0 or at >= len(rows):
-        return
-    for i, row in enumerate(rows[at:], start=at + 1):
-        row.idx -= 1
-    del rows[at]
-    CONFIG['dirty'] += 1
+def editor_current_buffer():
+    """Return the buffer showing, making one of the editor's state if
+    there is none yet."""
+    if CONFIG['buffer'] is None:
+        CONFIG['buffer'] = Buffer()
+        CONFIG['buffer'].state = None
+        CONFIG['buffers'].append(CONFIG['buffer'])
+    return CONFIG['buffer']
 
-def row_insert_char(row, at, c):
-    at = min(at, len(row.chars))
-    row.chars = row.chars[:at] + c + row.chars[at:]
-    CONFIG['dirty'] += 1
+def buffer_get(buffer, key):
+    """Return `buffer`'s value for `key`, showing or not."""
+    if buffer is CONFIG['buffer']:
+        return CONFIG[key]
+    return buffer.state[key]
 
-def row_delete_char(row, at):
-    if at < 0 or at >= len(row.chars):
+def buffer_is_blank(buffer):
+    """Whether `buffer` was never given a file or any text."""
+    return (buffer_get(buffer, 'filename') is None and
+            not buffer_get(buffer, 'dirty') and
+            len(buffer_get(buffer, 'row')) == 0)
+
+def editor_switch_buffer(buffer):
+    """Show `buffer` instead of the buffer showing. Only the references in
+    CONFIG are swapped, so this takes the same time for any size of file,
+    unless the buffer's rows were evicted and have to be read again."""
+    current = editor_current_buffer()
+    if buffer is current:
         return
-    row.chars = row.chars[:at] + row.chars[at+1:]
-    CONFIG['dirty'] += 1
+    editor_flush_row()
+    editor_replayed()
+    current.state = dict((key, CONFIG[key]) for key in BUFFER_KEYS)
+    current.size = None
+    CONFIG.update(buffer.state)
+    buffer.state = None
+    buffer.used = time.time()
+    CONFIG['buffer'] = buffer
+    CONFIG['frame'] = None
+    CONFIG['quit_times'] = QUIT_TIMES
+    if CONFIG['row'] is None:
+        editor_reload()
+    if CONFIG['follow']:
+        add_timer('follow', 0, editor_follow)
+    CONFIG['trim'] = trim_buffers()
 
-# Editor Operations
-def editor_insert_row(at, s):
+def editor_open_buffer(filename):
+    """Show `filename`, in the buffer it is open in if there is one, or
+    else in a new one. Returns whether it could be opened."""
+    path = os.path.realpath(filename)
+    for buffer in CONFIG['buffers']:
+        name = buffer_get(buffer, 'filename')
+        if name is not None and os.path.realpath(name) == path:
+            editor_switch_buffer(buffer)
+            if (not CONFIG['dirty'] and not CONFIG['follow'] and
+                    editor_file_changed()):
+                editor_reload()
+            return True
+    previous = editor_current_buffer()
+    buffer = Buffer()
+    CONFIG['buffers'].append(buffer)
+    editor_switch_buffer(buffer)
+    try:
+        editor_open(filename)
+    except (IOError, OSError) as e:
+        editor_switch_buffer(previous)
+        CONFIG['buffers'].remove(buffer)
+        set_status_message("Can't open %s: %s" % (filename, e.strerror))
+        return False
+    editor_recover()
+    if buffer_is_blank(previous):
+        CONFIG['buffers'].remove(previous)
+    return True
+
+def editor_next_buffer():
+    buffers = CONFIG['buffers']
+    if len(buffers) > 1:
+        at = buffers.index(editor_current_buffer())
+        editor_switch_buffer(buffers[(at + 1) % len(buffers)])
+
+def editor_reload():
+    """Read the file of a buffer whose rows were evicted back in, keeping
+    the cursor and scroll position where they were as far as it can.
+    Returns whether the file could be read."""
+    cursor = dict((key, CONFIG[key]) for key in ('cx', 'cy', 'rowoff',
+                                                 'coloff'))
+    editor_close_source()
+    try:
+        editor_open(CONFIG['filename'])
+    except (IOError, OSError) as e:
+        CONFIG['row'] = LineBuffer()
+        set_status_message("Can't reopen %s: %s" % (CONFIG['filename'],
+                                                     e.strerror))
+        return False
+    editor_load_until(cursor['cy'])
     rows = CONFIG['row']
-    for i, row in enumerate(rows[at:], start=at + 1):
-        row.idx += 1
-    # rows.append(Row(s, at))
-    rows.insert(at, Row(s, at))
+    CONFIG['cy'] = min(cursor['cy'], len(rows))
+    CONFIG['cx'] = (min(cursor['cx'], len(rows[CONFIG['cy']]))
+                    if CONFIG['cy'] < len(rows) else 0)
+    CONFIG['rowoff'] = min(cursor['rowoff'], CONFIG['cy'])
+    CONFIG['coloff'] = cursor['coloff']
+    return True
 
-def editor_insert_char(c):
-    if CONFIG['cy'] == len(CONFIG['row']):
-        editor_insert_row(CONFIG['cy'], '')
-    row_insert_char(CONFIG['row'][CONFIG['cy']], CONFIG['cx'], c)
-    CONFIG['cx'] += 1
-    CONFIG['dirty'] += 1
+def editor_dirty_buffers():
+    """Return how many buffers have unsaved changes."""
+    if CONFIG['buffer'] is None:
+        return 1 if CONFIG['dirty'] else 0
+    return len([b for b in CONFIG['buffers'] if buffer_get(b, 'dirty')])
 
-def editor_insert_newline():
-    if CONFIG['cx'] == 0:
-        editor_insert_row(CONFIG['cy'], '')
-        # CONFIG['row'].insert(CONFIG['cy'], Row('', CONFIG['cy']))
-    else:
-        row = CONFIG['row'][CONFIG['cy']]
-        # CONFIG['row'].insert(CONFIG['cy'] + 1, Row(row.chars[CONFIG['cx']:],
-        #CONFIG['cy']))
-        editor_insert_row(CONFIG['cy'] + 1, row.chars[CONFIG['cx']:])
-        row.chars = row.chars[:CONFIG['cx']]
-    CONFIG['cy'] += 1
-    CONFIG['cx'] = 0
-    CONFIG['dirty'] += 1
+def row_memory(row):
+    """Return roughly how many bytes `row` holds, and how many of those
+    are for its highlighting and render, which can be worked out again."""
+    derived = 0
+    if row._hl is not None:
+        derived += len(row._hl) * row._hl.itemsize
+    if row._render is not None and row._render is not row._chars:
+        derived += len(row._render)
+    if row._tabs is not None:
+        derived += sum(len(a) * a.itemsize for a in row._tabs)
+    return ROW_SIZE + len(row) + derived, derived
 
-def editor_delete_char():
-    if CONFIG['cy'] == len(CONFIG['row']):
-        return
-    if CONFIG['cx'] == 0 and CONFIG['cy'] == 0:
-        return
-    row = CONFIG['row'][CONFIG['cy']]
-    if CONFIG['cx']:
-        row_delete_char(row, CONFIG['cx'] - 1)
-        CONFIG['cx'] -= 1
-    else:
-        CONFIG['cx'] = len(CONFIG['row'][CONFIG['cy'] - 1].chars)
-        CONFIG['row'][CONFIG['cy'] - 1].chars += row.chars
-        CONFIG['dirty'] += 1
-        row_delete(CONFIG['cy'])
-        CONFIG['cy'] -= 1
+def search_memory(state):
+    """Return roughly how many bytes the searches kept for a buffer hold."""
+    return sum(len(search.lines) * search.lines.itemsize
+               for search in state['search_cache'].itervalues())
 
-# File I/O
+def trim_buffers():
+    """Bring the memory the buffers hold within MEMORY_BUDGET, yielding
+    every so often so the work can be spread over idle slices.
 
-def editor_open(filename):
-    CONFIG['filename'] = filename
+    Buffers not showing are measured once, when they stop showing; the one
+    showing counts for what it held when it was last measured. Over
+    budget, the buffers not showing are trimmed, least recently shown
+    first: first their highlighting, renders and searches are freed, and
+    if that is not enough, the rows of those without unsaved changes are
+    dropped too, to be read from disk again when they are next shown."""
+    current = CONFIG['buffer']
+    others = [b for b in CONFIG['buffers'] if b is not current]
+    for buffer in others:
+        if buffer.size is not None:
+            continue
+        size = search_memory(buffer.state)
+        if buffer.state['row'] is not None:
+            for i, row in enumerate(buffer.state['row'].loaded()):
+                size += row_memory(row)[0]
+                if i % 1024 == 1023:
+                    yield
+        buffer.size = size
 
-    select_sytnax_highlight()
+    others.sort(key=lambda b: b.used)
+    for evict in (buffer_drop_derived, buffer_drop_rows):
+        for buffer in others:
+            total = sum(b.size or 0 for b in CONFIG['buffers'])
+            if total <= MEMORY_BUDGET:
+                return
+            for _ in evict(buffer):
+                yield
 
-    f = open(filename, 'r')
-    try:
-        line = None
-        for i, line in enumerate(f.readlines()):
-            if line and line[-1] in ('\r', '\n'):
-                editor_insert_row(i, line[:-1])
-            else:
-                editor_insert_row(i, line)
-        else:
-            if line and line[-1] in ('\r', '\n'):
-                editor_insert_row(i, '')
-        CONFIG['dirty'] = 0
-    finally:
-        f.close()
+def buffer_drop_derived(buffer):
+    """Free the highlighting and renders of `buffer`'s rows and the
+    searches kept for it, yielding every so often."""
+    state = buffer.state
+    for search in state['search_cache'].itervalues():
+        search.cancel()
+    buffer.size -= search_memory(state)
+    state['search_cache'] = {}
+    state['search_pieces'] = None
+    state['search'] = None
+    if state['row'] is None:
+        return
+    for i, row in enumerate(state['row'].loaded()):
+        derived = row_memory(row)[1]
+        if derived:
+            row._hl = row._render = row._tabs = None
+            buffer.size -= derived
+        if i % 1024 == 1023:
+            yield
 
-def editor_save(fd):
-    if not CONFIG['filename']:
-        CONFIG['filename'] = editor_prompt(fd, 'Save as : %s')
-        if CONFIG['filename'] is None:
-            set_status_message('Save aborted')
-            return
-        select_sytnax_highlight()
-    try:
-        with open(CONFIG['filename'], 'w') as f:
-            data = '\n'.join(r.chars for r in CONFIG['row'])
-            f.write(data)
-    except OSError as e:
-        set_status_message("Can't save! I/O error: %s" % e)
-    CONFIG['dirty'] = 0
-    set_status_message('%d bytes written to disk' % len(data))
+def buffer_drop_rows(buffer):
+    """Drop the rows of `buffer` if they can be read from its file again."""
+    state = buffer.state
+    if (state['row'] is None or state['dirty'] or state['writer'] or
+            state['filename'] is None):
+        return
+    # A mapped file is left to be closed once nothing is using it, as a
+    # search that was cancelled may still be winding down.
+    state['source'] = None
+    state['row'] = None
+    state['edit_row'] = None
+    buffer.size = 0
+    yield
+
+def editor_trim_buffers(deadline):
+    """Idle job: carry on with `trim_buffers` after a buffer switch."""
+    trim = CONFIG['trim']
+    if trim is None:
+        return False
+    for _ in trim:
+        if time.time() >= deadline:
+            return True
+    CONFIG['trim'] = None
+    return False
 
 # Find
 
+def editor_search(query, regex):
+    """Return the Searcher for `query`, starting one if there isn't one for
+    the buffer as it is now. Finished searches are kept until the buffer
+    changes, and a plain query that extends one of them only rescans the
+    lines the shorter query matched."""
+    if CONFIG['search_version'] != CONFIG['version']:
+        CONFIG['search_version'] = CONFIG['version']
+        for search in CONFIG['search_cache'].itervalues():
+            search.cancel()
+        CONFIG['search_cache'] = {}
+        CONFIG['search_pieces'] = None
+    cache = CONFIG['search_cache']
+    search = cache.get((query, regex))
+    if search is not None:
+        return search
+
+    candidates = None
+    if not regex:
+        for (prev, prev_regex), prev_search in cache.items():
+            if (not prev_regex and prev_search.done and
+                    query.startswith(prev) and (candidates is None or
+                    len(prev_search.lines) < len(candidates))):
+                candidates = prev_search.lines
+
+    if CONFIG['search_pieces'] is None:
+        CONFIG['search_pieces'] = editor_snapshot()
+    for key, prev_search in cache.items():
+        if not prev_search.done:
+            prev_search.cancel()
+            del cache[key]
+    search = Searcher(CONFIG['search_pieces'], query, regex, candidates)
+    search.start()
+    cache[(query, regex)] = search
+    return search
+
 def editor_find_callback(query, code, static={}):
     if static.get('saved_hl') is not None:
-        CONFIG['row'][static['saved_hl_line']].hl = static['saved_hl']
+        row = CONFIG['row'][static['saved_hl_line']]
+        # Runs added to a long row while the match was shown aren't in the
+        # saved copy, so such a row is highlighted again.
+        if row._hl_resume == static['saved_hl_resume']:
+            row.hl = static['saved_hl']
+        else:
+            row.hl = None
         del static['saved_hl']
 
+    if code == CTRL_R:
+        static['regex'] = not static.get('regex')
+        static['last_match'] = -1
+
     if not query or code in (ord('\r'), ord('\x1b')):
         static['last_match'] = -1
         static['direction'] = 1
+        CONFIG['search'] = None
+        if code in (ord('\r'), ord('\x1b')):
+            static['regex'] = False
         return
     elif code in (ARROW_RIGHT, ARROW_DOWN):
         static['direction'] = 1
@@ -435,30 +3484,31 @@ def editor_find_callback(query, code, static={}):
 
     if static['last_match'] == -1:
         static['direction'] = 1
-    direction = static['direction']
-    current = static['last_match']
-    i = 0
-    while i < len(CONFIG['row']):
-        current += direction
-        if current == -1:
-            current = len(CONFIG['row']) - 1
-        elif current == len(CONFIG['row']):
-            current = 0
-        
-        row = CONFIG['row'][current]
-        match = row.render.find(query)
-        if match != -1:
-            static['last_match'] = current
-            CONFIG['cy'] = current
-            CONFIG['cx'] = row_rx_to_cx(row, match)
-            CONFIG['rowoff'] = len(CONFIG['row'])
-
-            static['saved_hl_line'] = current
-            static['saved_hl'] = list(CONFIG['row'][current].hl)
-            CONFIG['row'][current].hl[match:match + len(query)] = [HL_MATCH] * len(query)
+    try:
+        search = editor_search(query, static.get('regex', False))
+    except re.error as e:
+        CONFIG['search'] = None
+        set_status_message('Bad regex: %s' % e)
+        return
+    CONFIG['search'] = search
 
-            break
-        i += 1
+    current = search.next_line(static['last_match'], static['direction'],
+                               SEARCH_WAIT)
+    if current is None:
+        return
+    start, end = search.match(current)
+    editor_load_until(current)
+    static['last_match'] = current
+    CONFIG['cy'] = current
+    CONFIG['cx'] = start
+    CONFIG['rowoff'] = len(CONFIG['row'])
+
+    row = CONFIG['row'][current]
+    row_extend_syntax(row, end)
+    static['saved_hl_line'] = current
+    static['saved_hl'] = row.hl
+    static['saved_hl_resume'] = row._hl_resume
+    row.hl = hl_overlay(row.hl, start, end - start, HL_MATCH)
 
 
 def editor_find(fd):
@@ -467,16 +3517,317 @@ def editor_find(fd):
     saved_coloff = CONFIG['coloff']
     saved_rowoff = CONFIG['rowoff']
 
-    query = editor_prompt(fd, 'Search: %s (Use ESC/Arrows/Enter)', editor_find_callback)
+    query = editor_prompt(fd, 'Search: %s (Use ESC/Arrows/Enter, Ctrl-R regex)',
+                          editor_find_callback)
     if not query:
         CONFIG['cx'] = saved_cx
         CONFIG['cy'] = saved_cy
         CONFIG['coloff'] = saved_coloff
         CONFIG['rowoff'] = saved_rowoff
 
+def editor_replace(fd):
+    """Prompt for what to replace, showing how many matches there are as
+    it is typed, and what to replace it with, and replace every match."""
+    mode = {'regex': False}
+
+    def callback(query, code):
+        if code == CTRL_R:
+            mode['regex'] = not mode['regex']
+        CONFIG['search'] = None
+        if query and code not in (ord('\r'), ord('\x1b')):
+            try:
+                CONFIG['search'] = editor_search(query, mode['regex'])
+            except re.error:
+                pass
+
+    query = editor_prompt(fd, 'Replace: %s (Use ESC/Enter, Ctrl-R regex)',
+                          callback)
+    if query is None or editor_read_only():
+        return
+    replacement = editor_prompt(
+        fd, 'Replace %s with: %%s' % query.replace('%', '%%'),
+        allow_empty=True)
+    if replacement is None:
+        return
+    started = time.time()
+    try:
+        count, lines = editor_replace_all(query, replacement, mode['regex'])
+    except re.error as e:
+        set_status_message('Bad regex: %s' % e)
+        return
+    set_status_message('Replaced %d matches on %d lines in %.2fs' % (
+        count, lines, time.time() - started))
+
+def editor_replace_all(query, replacement, regex=False):
+    """Replace every match of `query` with `replacement`, which for a regex
+    is a template as for `re.sub`. The lines to change are the ones a search
+    finds, and they are changed in one pass, as one edit: highlighting is
+    only redone for them, when they are next shown. Returns the number of
+    matches replaced and of lines changed."""
+    search = editor_search(query, regex)
+    editor_journal('r', query, replacement, regex)
+    search.wait()
+    editor_flush_row()
+    if search.lines:
+        editor_load_until(search.lines[-1])
+    rows = CONFIG['row']
+    found = list(rows.rows_at(search.lines))
+    texts = [row.chars for row in found]
+    if regex:
+        results = map(functools.partial(search.pattern.subn, replacement),
+                      texts)
+    elif query and '\n' not in query and '\n' not in replacement:
+        # The matching lines are joined and replaced in one go, and split
+        # apart again where they were joined, rather than each one taking a
+        # call of its own.
+        joined = '\n'.join(texts)
+        results = itertools.izip(
+            joined.replace(query, replacement).split('\n'),
+            (text.count(query) for text in texts))
+    else:
+        results = [(text.replace(query, replacement), text.count(query))
+                   for text in texts]
+    count = 0
+    changed = 0
+    for k, row, text, (chars, n) in itertools.izip(search.lines, found, texts,
+                                                   results):
+        if chars == text:
+            continue
+        row.chars = chars
+        row.hl_in_comment = None
+        syntax_invalidate(k)
+        count += n
+        changed += 1
+    if changed:
+        CONFIG['version'] += 1
+        CONFIG['dirty'] += 1
+        if CONFIG['cy'] < len(rows):
+            CONFIG['cx'] = min(CONFIG['cx'], len(rows[CONFIG['cy']]))
+    return count, changed
+
+# Project search
+#
+# Ctrl-G looks for a string in every file under the current directory. The
+# files are scanned by a pool of worker processes, and what they find goes
+# into a buffer of its own as it comes in, one line per hit. Enter on a hit
+# opens its file at that line, and Esc stops a search that is running.
+
+def read_ignore_files(directory):
+    """Return the patterns of the ignore files in `directory`, as
+    (directory, pattern, negated, directories only, anchored) tuples."""
+    patterns = []
+    for name in IGNORE_FILES:
+        try:
+            with open(os.path.join(directory, name)) as f:
+                lines = f.read().splitlines()
+        except IOError:
+            continue
+        for line in lines:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            negated = line.startswith('!')
+            if negated:
+                line = line[1:]
+            dir_only = line.endswith('/')
+            line = line.rstrip('/')
+            # A pattern with a slash in it is matched against the path from
+            # the ignore file's directory, and one without against the name.
+            anchored = '/' in line
+            patterns.append((directory, line.lstrip('/'), negated, dir_only,
+                             anchored))
+    return patterns
+
+def is_ignored(patterns, path, is_dir):
+    """Whether the last of `patterns` that matches `path` ignores it."""
+    ignored = False
+    for directory, pattern, negated, dir_only, anchored in patterns:
+        if dir_only and not is_dir:
+            continue
+        if anchored:
+            name = path[len(directory) + 1:]
+        else:
+            name = os.path.basename(path)
+        if fnmatch.fnmatchcase(name, pattern):
+            ignored = not negated
+    return ignored
+
+def project_files(root):
+    """Yield the files under `root`, leaving out version control
+    directories and whatever the ignore files on the way down rule out."""
+    patterns = {root: read_ignore_files(root)}
+    for directory, dirs, files in os.walk(root):
+        inherited = patterns.pop(directory)
+        dirs[:] = [d for d in sorted(dirs) if d not in VCS_DIRS and
+                   not is_ignored(inherited, os.path.join(directory, d), True)]
+        for d in dirs:
+            path = os.path.join(directory, d)
+            patterns[path] = inherited + read_ignore_files(path)
+        for name in sorted(files):
+            path = os.path.join(directory, name)
+            if not is_ignored(inherited, path, False):
+                yield path
+
+def search_files(task):
+    """Worker: search each of the files the (paths, query) `task` names,
+    returning their hits as `search_file` does."""
+    paths, query = task
+    return [(path, search_file(path, query)) for path in paths]
+
+def search_file(path, query):
+    """Return the (line number, text) of each line of file `path` that has
+    `query` in it. The file is mapped and searched as bytes, and left out
+    if it looks binary."""
+    hits = []
+    try:
+        with open(path, 'rb') as f:
+            if not os.fstat(f.fileno()).st_size:
+                return hits
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (IOError, OSError, ValueError, mmap.error):
+        return hits
+    try:
+        if data.find('\0', 0, 8192) != -1:
+            return hits
+        line = 0
+        counted = 0
+        at = data.find(query)
+        while at != -1:
+            line += data[counted:at].count('\n')
+            counted = at
+            start = data.rfind('\n', 0, at) + 1
+            end = data.find('\n', at)
+            if end == -1:
+                end = len(data)
+            hits.append((line, data[start:min(end, start + HIT_WIDTH)]))
+            at = data.find(query, end)
+    finally:
+        data.close()
+    return hits
+
+def search_worker_init():
+    # Keys and window changes are for the editor, not the workers.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGWINCH, signal.SIG_DFL)
+
+
+class ProjectSearch(object):
+    """Looks for `query` in the files under `root` with a pool of worker
+    processes. The tree is walked as the workers go, and `poll` hands back
+    the hits of the files they have finished with."""
+
+    BATCH = 16
+
+    def __init__(self, root, query, buffer):
+        self.root = root
+        self.query = query
+        self.buffer = buffer
+        self.files = 0
+        self.hits = 0
+        self.done = False
+        self._pool = multiprocessing.Pool(initializer=search_worker_init)
+        files = project_files(root)
+        batches = iter(lambda: list(itertools.islice(files, self.BATCH)), [])
+        self._results = self._pool.imap_unordered(
+            search_files, ((paths, query) for paths in batches))
+
+    def poll(self):
+        """Return the hits found since the last call, as (path, line
+        number, text) tuples."""
+        hits = []
+        while not self.done:
+            try:
+                batch = self._results.next(0)
+            except multiprocessing.TimeoutError:
+                break
+            except StopIteration:
+                self.done = True
+                self._pool.close()
+                break
+            self.files += len(batch)
+            for path, found in batch:
+                hits.extend((path, line, text) for line, text in found)
+        self.hits += len(hits)
+        return hits
+
+    def cancel(self):
+        """Stop the workers where they are."""
+        if not self.done:
+            self.done = True
+            self._pool.terminate()
+
+
+def editor_project_search(fd):
+    query = editor_prompt(fd, 'Search files: %s (ESC to cancel)')
+    if not query:
+        return
+    editor_cancel_project_search()
+    buffer = Buffer()
+    CONFIG['buffers'].append(buffer)
+    editor_switch_buffer(buffer)
+    CONFIG['title'] = '[%s]' % query
+    CONFIG['hits'] = []
+    CONFIG['project_search'] = ProjectSearch(os.getcwd(), query, buffer)
+    editor_poll_project_search()
+
+def editor_poll_project_search():
+    """Timer: add the hits found since the last look to the search's
+    buffer, showing or not."""
+    search = CONFIG['project_search']
+    if search is None:
+        return
+    hits = search.poll()
+    buffer = search.buffer
+    state = CONFIG if buffer is CONFIG['buffer'] else buffer.state
+    rows = state['row']
+    for path, line, text in hits:
+        rows.append(Row('%s:%d: %s' % (os.path.relpath(path, search.root),
+                                       line + 1, text)))
+        state['hits'].append((path, line))
+    if hits:
+        state['version'] += 1
+    if search.done:
+        CONFIG['project_search'] = None
+        set_status_message('%d matches in %d files' % (search.hits,
+                                                       search.files))
+    else:
+        set_status_message('Searching... %d matches in %d files so far' % (
+            search.hits, search.files))
+        add_timer('project_search', PROGRESS_INTERVAL,
+                  editor_poll_project_search)
+
+def editor_cancel_project_search():
+    search = CONFIG['project_search']
+    if search is None:
+        return
+    search.cancel()
+    CONFIG['project_search'] = None
+    CONFIG['timers'].pop('project_search', None)
+    set_status_message('Search stopped: %d matches in %d files' % (
+        search.hits, search.files))
+
+def editor_open_hit():
+    """Open the file of the hit on the cursor's line at the hit."""
+    if CONFIG['cy'] >= len(CONFIG['hits']):
+        return
+    path, line = CONFIG['hits'][CONFIG['cy']]
+    if not editor_open_buffer(path):
+        return
+    editor_load_until(line)
+    CONFIG['cy'] = min(line, len(CONFIG['row']))
+    CONFIG['cx'] = 0
+    CONFIG['rowoff'] = len(CONFIG['row'])
+
 # Output
 
 def editor_scroll():
+    editor_load_source()
+    editor_poll_writer()
+    if CONFIG['edit_row'] is not None and (
+            CONFIG['cy'] >= len(CONFIG['row']) or
+            CONFIG['row'][CONFIG['cy']] is not CONFIG['edit_row']):
+        editor_flush_row()
+
     CONFIG['rx'] = 0
     if CONFIG['cy'] < len(CONFIG['row']):
         CONFIG['rx'] = row_cx_to_rx(CONFIG['row'][CONFIG['cy']], CONFIG['cx'])
@@ -490,86 +3841,346 @@ def editor_scroll():
     if CONFIG['rx'] >= CONFIG['coloff'] + CONFIG['screen_cols']:
         CONFIG['coloff'] = CONFIG['rx'] - CONFIG['screen_cols'] + 1
 
+def draw_row(row):
+    """Return the visible part of `row` with its color escapes, a run of
+    one color at a time. Only the characters on screen are looked at: the
+    visible columns are mapped back to characters through the row's tab
+    map, and the row is only highlighted as far as the last of them."""
+    buffer = []
+    current_color = -1
+    start = CONFIG['coloff']
+    if row._gap is None:
+        render = row.render
+        tabs = row.tabs is not None
+        end = min(start + CONFIG['screen_cols'], len(render))
+        base = 0
+    else:
+        # Only the columns on screen of the row being edited are put
+        # together.
+        tabs = row._gap.has_tabs()
+        end = min(start + CONFIG['screen_cols'], row._gap.columns())
+        render = row._gap.render(start, end)
+        base = start
+    first = row_column(row, start)
+    last = row_column(row, end - 1) + 1 if end > start else first
+    row_extend_syntax(row, last)
+    for run_start, run_end, hl in hl_runs(row.hl, first, last):
+        if tabs:
+            run_start = max(row_cx_to_rx(row, run_start), start)
+            run_end = min(row_cx_to_rx(row, run_end), end)
+        color = SYNTAX_TO_COLOR[hl]
+        # Every other piece is a control character, shown inverted.
+        for k, piece in enumerate(CONTROL_RE.split(
+                render[run_start - base:run_end - base])):
+            if k % 2:
+                code = ord(piece)
+                sym = chr(ord('@') + code) if code <= 26 else '?'
+                buffer.append('\x1b[7m' + sym + '\x1b[m')
+                if current_color != -1:
+                    buffer.append('\x1b[%dm' % current_color)
+            elif piece:
+                if color != current_color:
+                    buffer.append('\x1b[%dm' % color)
+                    current_color = color
+                buffer.append(piece)
+    buffer.append('\x1b[39m')
+    return ''.join(buffer)
+
 def draw_rows():
+    """Return one string per text line of the screen."""
     width = CONFIG['screen_cols']
 
-    buffer = ''
+    lines = []
     for i in xrange(CONFIG['screen_rows']):
         filerow = i + CONFIG['rowoff']
         if filerow >= len(CONFIG['row']):
             if len(CONFIG['row']) == 0 and i == CONFIG['screen_rows'] / 3:
                 welcome = 'Ted editor -- version %s' % VERSION
-                buffer += '~' + welcome[:width].center(width)[1:]
+                lines.append('~' + welcome[:width].center(width)[1:])
             else:
-                buffer += '~'
+                lines.append('~')
         else:
-            current_color = -1
-            print >> sys.stderr, CONFIG['row'][filerow].hl
-            for s, i in zip(CONFIG['row'][filerow].render,
-                            CONFIG['row'][filerow].hl)[CONFIG['coloff']:][:width]:
-                color = SYNTAX_TO_COLOR[i]
-                code = ord(s)
-                if curses.ascii.iscntrl(code):
-                    sym = chr(ord('@') + code) if code <= 26 else '?'
-                    buffer += '\x1b[7m' + sym + '\x1b[m'
-                    if current_color != -1:
-                        buffer += '\x1b[%dm' % current_color
-                elif color == current_color:
-                    buffer += s
-                else:
-                    buffer += '\x1b[%dm%s' % (color, s)
-                    current_color = color
-            buffer += '\x1b[39m'
-        buffer += '\x1b[K\r\n'
-    return buffer
+            lines.append(draw_row(CONFIG['row'][filerow]))
+    return lines
 
 def draw_status_bar():
-    filename = CONFIG['filename'][:20] if CONFIG['filename'] else '[No Name]'
+    filename = (CONFIG['filename'] or CONFIG['title'] or '[No Name]')[:20]
+    if CONFIG['dirty']:
+        state = '(modified)'
+    elif CONFIG['follow']:
+        state = '(following)'
+    else:
+        state = ''
     status = '%s - %d lines %d:%d %s' % (filename, len(CONFIG['row']),
-                                         CONFIG['cy'], CONFIG['cx'],
-                                         "(modified)" if CONFIG['dirty'] else '')
+                                         CONFIG['cy'], CONFIG['cx'], state)
+    buffers = CONFIG['buffers']
+    if len(buffers) > 1:
+        status = '[%d/%d] %s' % (buffers.index(CONFIG['buffer']) + 1,
+                                 len(buffers), status)
     rstatus = '%s | %d/%d' % (
         CONFIG['syntax']['filetype'] if CONFIG['syntax'] else 'no ft',
         CONFIG['cy'] + 1,
         len(CONFIG['row']))
+    search = CONFIG['search']
+    if search is not None:
+        rstatus = '%s%d%s matches | %s' % ('regex ' if search.regex else '',
+                                           search.count,
+                                           '' if search.done else '+',
+                                           rstatus)
+    if CONFIG['profiler'] is not None:
+        rstatus = '%s | %s ms' % (rstatus, CONFIG['profiler'].breakdown())
     rstatus = rstatus.rjust(CONFIG['screen_cols'] - len(status))
-    return '\x1b[7m' + (status + rstatus)[:CONFIG['screen_cols']] + '\x1b[m\r\n'
+    return '\x1b[7m' + (status + rstatus)[:CONFIG['screen_cols']] + '\x1b[m'
 
 def draw_message_bar():
-    buffer = '\x1b[K'
-    if CONFIG['status_msg'] and  time.time() - CONFIG['status_msg_time'] < 5:
-        buffer += CONFIG['status_msg'][:CONFIG['screen_cols']]
-    return buffer
+    if (CONFIG['status_msg'] and
+            time.time() - CONFIG['status_msg_time'] < STATUS_TIMEOUT):
+        return CONFIG['status_msg'][:CONFIG['screen_cols']]
+    return ''
+
+def draw_scroll(buffer, frame, delta):
+    """Scroll the text area of the terminal by `delta` lines, the way
+    `rowoff` just moved, and shift `frame` to match what is now on screen.
+    Lines scrolled into view are left as None so they get drawn."""
+    rows = CONFIG['screen_rows']
+    buffer.append('\x1b[1;%dr' % rows)
+    if delta > 0:
+        buffer.append('\x1b[%dS' % delta)
+        frame[:rows] = frame[delta:rows] + [None] * delta
+    else:
+        buffer.append('\x1b[%dT' % -delta)
+        frame[:rows] = [None] * -delta + frame[:rows + delta]
+    buffer.append('\x1b[r')
 
 def refresh_screen(fd):
-    editor_scroll()
+    """Bring the terminal up to date, sending only the lines that differ
+    from the last frame written."""
+    with timed('frame'):
+        draw_screen(fd)
+    if CONFIG['profiler'] is not None:
+        CONFIG['profiler'].end_frame()
+
+def draw_screen(fd):
+    with timed('scroll'):
+        editor_scroll()
 
-    buffer = ''
-    buffer += '\x1b[?25l'
-    buffer += '\x1b[H'
-    buffer += draw_rows()
-    buffer += draw_status_bar()
-    buffer += draw_message_bar()
-    buffer += '\x1b[%d;%dH' % ((CONFIG['cy'] - CONFIG['rowoff']) + 1, 
-                               (CONFIG['rx'] - CONFIG['coloff']) + 1)
-    buffer += '\x1b[?25h'
+    with timed('draw'):
+        lines = draw_rows()
+        lines.append(draw_status_bar())
+        lines.append(draw_message_bar())
 
-    os.write(fd, buffer)
+    buffer = ['\x1b[?25l']
+    frame = CONFIG['frame']
+    if frame is None or len(frame) != len(lines):
+        frame = [None] * len(lines)
+    else:
+        delta = CONFIG['rowoff'] - CONFIG['frame_rowoff']
+        if delta and abs(delta) <= CONFIG['screen_rows'] // 2:
+            draw_scroll(buffer, frame, delta)
+
+    for y, line in enumerate(lines):
+        if frame[y] != line:
+            buffer.append('\x1b[%d;1H' % (y + 1))
+            buffer.append(line)
+            buffer.append('\x1b[K')
+    CONFIG['frame'] = lines
+    CONFIG['frame_rowoff'] = CONFIG['rowoff']
+
+    buffer.append('\x1b[%d;%dH' % ((CONFIG['cy'] - CONFIG['rowoff']) + 1,
+                                   (CONFIG['rx'] - CONFIG['coloff']) + 1))
+    buffer.append('\x1b[?25h')
+
+    with timed('write'):
+        editor_write(fd, ''.join(buffer))
+
+def editor_write(fd, data):
+    while data:
+        data = data[os.write(fd, data):]
 
 def set_status_message(fmt, *args):
     CONFIG['status_msg'] = fmt
     CONFIG['status_msg_time'] = time.time()
+    # Wake up to clear it even if no key comes.
+    add_timer('status', STATUS_TIMEOUT)
+
+# Events
+
+def add_timer(name, delay, callback=None):
+    """Call `callback` in `delay` seconds, replacing any timer already set
+    under `name`. The screen is redrawn once timers have run, so a timer
+    with no callback just wakes the editor up to show how things stand."""
+    CONFIG['timers'][name] = (time.time() + delay, callback)
+
+def run_timers():
+    """Run the timers that are due. Returns whether there were any."""
+    now = time.time()
+    due = [(name, callback)
+           for name, (when, callback) in CONFIG['timers'].iteritems()
+           if when <= now]
+    for name, callback in due:
+        del CONFIG['timers'][name]
+        if callback is not None:
+            callback()
+    return bool(due)
+
+def next_timer():
+    """Seconds until the next timer is due, or None if none is set."""
+    if not CONFIG['timers']:
+        return None
+    when = min(when for when, callback in CONFIG['timers'].itervalues())
+    return max(when - time.time(), 0)
+
+def run_idle_jobs():
+    """Give the idle jobs a slice of time. Each job is called with the
+    time it has to stop by, and returns whether it has more to do. Returns
+    whether any of them has."""
+    deadline = time.time() + IDLE_SLICE
+    busy = False
+    for job in CONFIG['idle_jobs']:
+        if time.time() >= deadline:
+            return True
+        busy = job(deadline) or busy
+    return busy
+
+def init_signals():
+    """Have signals the editor cares about written to a pipe, so they wake
+    up the select in `editor_wait_key` rather than interrupting whatever
+    is running."""
+    r, w = os.pipe()
+    for end in (r, w):
+        flags = fcntl.fcntl(end, fcntl.F_GETFL)
+        fcntl.fcntl(end, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+    CONFIG['signal_pipe'] = (r, w)
+    signal.signal(signal.SIGWINCH, on_signal)
+    signal.siginterrupt(signal.SIGWINCH, False)
+
+def on_signal(signum, frame):
+    try:
+        os.write(CONFIG['signal_pipe'][1], chr(signum))
+    except OSError:
+        # The pipe is full, so a wake-up is on its way already.
+        pass
+
+def handle_signals(fd):
+    try:
+        signums = os.read(CONFIG['signal_pipe'][0], 64)
+    except OSError as err:
+        if err.errno in (errno.EAGAIN, errno.EINTR):
+            return
+        raise
+    if chr(signal.SIGWINCH) in signums:
+        editor_resize(fd)
+
+def editor_resize(fd):
+    CONFIG.update(get_window_size(fd))
+    CONFIG['screen_rows'] -= 2
+    CONFIG['frame'] = None
+
+def editor_busy():
+    """Whether something the screen reports on is going on in the
+    background."""
+    search = CONFIG['search']
+    source = CONFIG['source']
+    return (CONFIG['writer'] is not None or
+            (search is not None and not search.done) or
+            (source is not None and not source.done))
+
+def editor_wait_key(fd):
+    """Return the next key, as `read_key` does. While waiting for it, run
+    timers, handle signals and give idle jobs their slices, redrawing
+    whenever one of those may have changed the screen."""
+    idle = True
+    while not CONFIG['keys'] and not CONFIG['input']:
+        if editor_busy() and 'progress' not in CONFIG['timers']:
+            add_timer('progress', PROGRESS_INTERVAL)
+        timeout = next_timer()
+        if idle:
+            timeout = 0
+        fds = [fd]
+        if CONFIG['signal_pipe'] is not None:
+            fds.append(CONFIG['signal_pipe'][0])
+        ready = wait_readable(fds, timeout)
+        if fd in ready:
+            break
+        redraw = False
+        if ready:
+            handle_signals(fd)
+            redraw = True
+        if run_timers():
+            redraw = True
+        if redraw:
+            # What the signals and timers did, such as reading more of a
+            # pipe, may have given the idle jobs something to do again.
+            idle = True
+        if idle:
+            idle = run_idle_jobs()
+        if CONFIG['redraw']:
+            CONFIG['redraw'] = False
+            redraw = True
+        if redraw:
+            refresh_screen(fd)
+    return read_key(fd)
+
+def editor_highlight_ahead(deadline):
+    """Idle job: highlight the screenfuls of lines either side of the one
+    showing, below first, so paging finds them done."""
+    rows = CONFIG['row']
+    height = CONFIG['screen_rows']
+    below = CONFIG['rowoff'] + height
+    above = max(CONFIG['rowoff'] - height, 0)
+    for at in itertools.chain(xrange(below, min(below + height, len(rows))),
+                              xrange(above, min(CONFIG['rowoff'], len(rows)))):
+        rows[at].hl
+        if time.time() >= deadline:
+            return True
+    return False
+
+def editor_unload_rows(deadline):
+    """Idle job: keep the rows read from a mapped file to about
+    LOADED_ROWS, so paging through a huge file doesn't end up with all of
+    it in memory. The rows read longest ago are turned back into lines of
+    the file, unless they have been changed, are near the screen or hold
+    the state of the syntax scan."""
+    rows = CONFIG['row']
+    if rows is None:
+        return False
+    fetched = rows.fetched
+    near = CONFIG['screen_rows'] * 2
+    while len(fetched) > LOADED_ROWS:
+        row, source, k = fetched.popleft()
+        if (row._leaf is None or row._gap is not None or
+                row.chars != source.line(k)):
+            continue
+        at = row.idx
+        if at % SYNTAX_CHECKPOINT == 0:
+            continue
+        if -near <= at - CONFIG['rowoff'] < CONFIG['screen_rows'] + near:
+            fetched.append((row, source, k))
+        else:
+            rows.unload(row, source, k)
+        if time.time() >= deadline:
+            return True
+    return False
+
+CONFIG['idle_jobs'].append(editor_highlight_ahead)
+CONFIG['idle_jobs'].append(editor_scan_syntax)
+CONFIG['idle_jobs'].append(editor_trim_buffers)
+CONFIG['idle_jobs'].append(editor_unload_rows)
 
 # Input
 
-def editor_prompt(fd, prompt, callback=None):
+def editor_prompt(fd, prompt, callback=None, allow_empty=False):
     buf = ''
     while True:
         set_status_message(prompt % buf)
-        refresh_screen(fd)
+        if not input_pending(fd):
+            refresh_screen(fd)
 
-        code = read_key(fd)
-        if code in (DEL_KEY, ctrl('h'), BACKSPACE):
+        code = editor_wait_key(fd)
+        if isinstance(code, str):
+            buf += ''.join(c for c in code
+                           if not curses.ascii.iscntrl(c) and c < '\x80')
+        elif code in (DEL_KEY, ctrl('h'), BACKSPACE):
             buf = buf[:-1]
         elif code == ord('\x1b'):
             set_status_message('')
@@ -577,7 +4188,7 @@ def editor_prompt(fd, prompt, callback=None):
                 callback(buf, code)
             return None
         elif code == ord('\r'):
-            if buf:
+            if buf or allow_empty:
                 set_status_message('')
                 if callback:
                     callback(buf, code)
@@ -589,52 +4200,182 @@ def editor_prompt(fd, prompt, callback=None):
             callback(buf, code)
 
 def move_cursor(key_code):
-    row = CONFIG['row'][CONFIG['cy']].chars if CONFIG['cy'] < len(CONFIG['row']) else None
+    rows = CONFIG['row']
+    cy = CONFIG['cy']
+    cx = CONFIG['cx']
+    # The length of the row the cursor is on, looked up only once unless
+    # the cursor goes to another row.
+    size = len(rows[cy]) if cy < len(rows) else None
 
     if key_code == ARROW_LEFT:
-        if CONFIG['cx'] != 0:
-            CONFIG['cx'] -= 1
-        elif CONFIG['cy'] > 0:
-            CONFIG['cy'] -= 1
-            CONFIG['cx'] = len(CONFIG['row'][CONFIG['cy']].chars)
-    elif key_code == ARROW_RIGHT and row is not None:
-        if CONFIG['cx'] < len(row):
-            CONFIG['cx'] += 1
-        elif CONFIG['cx'] == len(row):
-            CONFIG['cy'] += 1
-            CONFIG['cx'] = 0
-    elif key_code == ARROW_UP and CONFIG['cy'] != 0:
-        CONFIG['cy'] -= 1
-    elif key_code == ARROW_DOWN and CONFIG['cy'] < len(CONFIG['row']) - 1:
-        CONFIG['cy'] += 1
+        if cx != 0:
+            cx -= 1
+        elif cy > 0:
+            cy -= 1
+            cx = size = len(rows[cy])
+    elif key_code == ARROW_RIGHT and size is not None:
+        if cx < size:
+            cx += 1
+        elif cx == size:
+            cy += 1
+            cx = 0
+            size = None
+    elif key_code == ARROW_UP and cy != 0:
+        cy -= 1
+        size = None
+    elif key_code == ARROW_DOWN and cy < len(rows) - 1:
+        cy += 1
+        size = None
+
+    if size is None:
+        size = len(rows[cy]) if cy < len(rows) else 0
+    CONFIG['cy'] = cy
+    CONFIG['cx'] = min(cx, size)
+
+# Macros
+#
+# Ctrl-K starts recording the keys typed, and Ctrl-K again stops. Ctrl-E
+# plays them back a given number of times, or until they stop moving the
+# cursor down the buffer. Playback runs the keys straight through
+# `handle_key` with nothing drawn, and without working out the number of
+# each line changed to tell the syntax scan: the scan is told once, from
+# the first of them, at the end, when the screen is drawn again.
+
+def editor_toggle_macro():
+    if CONFIG['recording'] is None:
+        CONFIG['recording'] = []
+        set_status_message('Recording a macro; Ctrl-K to stop')
+        return
+    CONFIG['macro'] = CONFIG['recording']
+    CONFIG['recording'] = None
+    set_status_message('Macro of %d keys recorded; Ctrl-E to play it' %
+                       len(CONFIG['macro']))
+
+def editor_replayed():
+    """Have the scan look again at the lines the macro being played has
+    changed in the buffer showing, and journal the edits it made there.
+    The rows themselves were marked as they were edited."""
+    low = CONFIG['replay_low']
+    if low is not None:
+        syntax_invalidate(low)
+        # Which lines below the first changed isn't known, so the scan
+        # mustn't skip any of them.
+        CONFIG['syntax_reached'] = min(CONFIG['syntax_reached'], low)
+        CONFIG['replay_low'] = None
+    if CONFIG['replay_records']:
+        editor_journal_records(CONFIG['replay_records'])
+        CONFIG['replay_records'] = []
 
-    row = CONFIG['row'][CONFIG['cy']].chars if CONFIG['cy'] < len(CONFIG['row']) else ''
-    CONFIG['cx'] = min(CONFIG['cx'], len(row))
+def editor_replay_macro(fd):
+    macro = CONFIG['macro']
+    if CONFIG['recording'] is not None:
+        set_status_message('Stop recording with Ctrl-K first')
+        return
+    if not macro:
+        set_status_message('No macro; Ctrl-K records one')
+        return
+    count = editor_prompt(fd, 'Play the macro how many times? '
+                          '(Enter = to the end): %s', allow_empty=True)
+    if count is None:
+        return
+    if count and not count.isdigit():
+        set_status_message('Not a number: %s' % count)
+        return
+    # Played to the end, it can't take more passes than there are lines,
+    # even if it adds lines as it goes.
+    times = int(count) if count else len(CONFIG['row'])
+    keys = CONFIG['keys']
+    # Keys typed ahead stay behind the macro's.
+    waiting = len(keys)
+    passes = 0
+    buffer, dirty = CONFIG['buffer'], CONFIG['dirty']
+    CONFIG['replaying'] = True
+    try:
+        while passes < times:
+            cy = CONFIG['cy']
+            rows = CONFIG['row']
+            # Played to the end, it stops at the end of the last line: the
+            # empty row after a final newline isn't a line to play it on.
+            if not count and (cy >= len(rows) or
+                              cy == len(rows) - 1 and not len(rows[cy])):
+                break
+            keys.extendleft(reversed(macro))
+            while len(keys) > waiting:
+                handle_key(fd, keys.popleft())
+            passes += 1
+            if not count and CONFIG['cy'] <= cy:
+                break
+    finally:
+        CONFIG['replaying'] = False
+        # However many keys it took, the macro is one change to the buffer.
+        if CONFIG['buffer'] is buffer and CONFIG['dirty'] != dirty:
+            CONFIG['dirty'] = dirty + 1
+        editor_replayed()
+        CONFIG['frame'] = None
+    set_status_message('Macro played %d times' % passes)
 
 def process_key_press(fd):
-    code = read_key(fd)
+    code = editor_wait_key(fd)
+    if code == -1:
+        return
+    with timed('key'):
+        handle_key(fd, code)
 
-    if code == ord('\r'):
-        editor_insert_newline()
-    elif code == ord(ctrl('q')):
-        if CONFIG['dirty'] and CONFIG['quit_times'] > 0:
-            set_status_message('WARNING!!! File has unsaved changes. '
+def handle_key(fd, code):
+    if isinstance(code, str):
+        editor_insert_text(code)
+    elif code == ord('\r'):
+        if CONFIG['hits'] is not None:
+            editor_open_hit()
+        else:
+            editor_insert_newline()
+    elif code == CTRL_Q:
+        if CONFIG['serving']:
+            # The buffers stay open in the server for next time.
+            raise SessionEnd
+        dirty = editor_dirty_buffers()
+        if dirty and CONFIG['quit_times'] > 0:
+            if dirty == 1 and CONFIG['dirty']:
+                unsaved = 'File has unsaved changes.'
+            else:
+                unsaved = '%d files have unsaved changes.' % dirty
+            set_status_message('WARNING!!! %s '
                                'Press Ctrl-Q %d more times to quit.' % 
-                               CONFIG['quit_times'])
+                               (unsaved, CONFIG['quit_times']))
             CONFIG['quit_times'] -= 1
             return
+        # Quitting on purpose gives up the unsaved edits for good.
+        editor_close_journals(discard=True)
         os.write(fd, '\x1b[2J')
         os.write(fd, '\x1b[H')
         sys.exit(0)
-    elif code == ord(ctrl('s')):
+    elif code == CTRL_S:
         editor_save(fd)
     elif code == HOME_KEY:
         CONFIG['cx'] = 0
     elif code == END_KEY:
         if CONFIG['cy'] < len(CONFIG['row']):
-            CONFIG['cx'] = len(CONFIG['row'][CONFIG['cy']].chars)
-    elif code == ord(ctrl('f')):
+            CONFIG['cx'] = len(CONFIG['row'][CONFIG['cy']])
+    elif code == CTRL_F:
         editor_find(fd)
+    elif code == CTRL_R:
+        editor_replace(fd)
+    elif code == CTRL_O:
+        filename = editor_prompt(fd, 'Open: %s')
+        if filename is not None:
+            editor_open_buffer(filename)
+    elif code == CTRL_N:
+        editor_next_buffer()
+    elif code == CTRL_T:
+        editor_toggle_follow()
+    elif code == CTRL_G:
+        editor_project_search(fd)
+    elif code == CTRL_K:
+        editor_toggle_macro()
+    elif code == CTRL_E:
+        editor_replay_macro(fd)
+    elif code == WINDOW_SIZE:
+        editor_resize(fd)
     elif code in (BACKSPACE, ctrl('h'), DEL_KEY):
         if code == DEL_KEY:
             move_cursor(ARROW_RIGHT)
@@ -650,26 +4391,335 @@ def process_key_press(fd):
             move_cursor(ARROW_DOWN)
     elif code in (ARROW_UP, ARROW_DOWN, ARROW_LEFT, ARROW_RIGHT):
         move_cursor(code)
-    elif code in (ctrl('l'), '\x1b'):
-        pass
+    elif code == CTRL_L:
+        CONFIG['frame'] = None
+    elif code == CTRL_P:
+        editor_profile_dump()
+    elif code == 0x1b:
+        editor_cancel_project_search()
     else:
         editor_insert_char(chr(code))
 
+def editor_profile_dump():
+    profiler = CONFIG['profiler']
+    if profiler is None:
+        set_status_message('Not profiling; start ted with --profile or '
+                           'TED_PROFILE=1')
+        return
+    try:
+        cprofiled = profiler.dump(PROFILE_FILE)
+    except IOError as e:
+        set_status_message("Can't write profile! I/O error: %s" % e)
+        return
+    if cprofiled:
+        set_status_message('Profile written to %s.txt and %s.prof' % (
+            PROFILE_FILE, PROFILE_FILE))
+    else:
+        set_status_message('Profile written to %s.txt' % PROFILE_FILE)
+
+def editor_open_files(filenames, follow=False, pipe=None):
+    """Open each of `filenames` in a buffer, following them if `follow`,
+    and show the first. A filename of '-' stands for the pipe `pipe`."""
+    stdin = None
+    for filename in filenames:
+        if filename == '-':
+            editor_open_pipe(pipe)
+            stdin = CONFIG['buffer']
+        elif editor_open_buffer(filename) and follow and not CONFIG['follow']:
+            editor_toggle_follow()
+    if filenames[:1] == ['-']:
+        editor_switch_buffer(stdin)
+    elif filenames:
+        editor_open_buffer(filenames[0])
+
+def editor_run(fd):
+    while True:
+        if not input_pending(fd):
+            refresh_screen(fd)
+        process_key_press(fd)
+
+# Server
+#
+# `ted --server` starts a server that keeps its buffers, with their line
+# indexes and highlighting, from one session to the next. `ted --attach`
+# hands its terminal to the server: keys go to the server as they are
+# typed, and what the server draws, only the lines that changed, comes
+# back. One terminal is attached at a time. `ted --stop-server` stops
+# the server, leaving any unsaved edits in its buffers to be recovered
+# from their journals.
+
+class SessionEnd(Exception):
+    """Raised to end the session of the terminal attached to the server."""
+
+
+class ServerStop(Exception):
+    """Raised to stop the server."""
+
+
+def server_address():
+    """Return the path of the server's socket, in a directory no other
+    user can get into."""
+    try:
+        os.mkdir(SERVER_DIR, 0700)
+    except OSError as err:
+        if err.errno != errno.EEXIST:
+            raise
+    st = os.lstat(SERVER_DIR)
+    if (not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or
+            st.st_mode & 0077):
+        raise OSError(errno.EPERM, '%s is not private' % SERVER_DIR)
+    return os.path.join(SERVER_DIR, 'server')
+
+def server_start():
+    """Start a server in the background, unless one is running. Returns
+    once the server is listening, with its socket's path."""
+    path = server_address()
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+    except socket.error:
+        if os.path.exists(path):
+            # Left behind by a server that is gone.
+            os.unlink(path)
+    else:
+        raise OSError(errno.EADDRINUSE, 'A server is running already')
+    finally:
+        probe.close()
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    listener.listen(8)
+    if os.fork():
+        return path
+    os.setsid()
+    if os.fork():
+        os._exit(0)
+    null = os.open(os.devnull, os.O_RDWR)
+    os.dup2(null, 0)
+    os.dup2(null, 1)
+    try:
+        if not os.path.isdir(STATE_DIR):
+            os.makedirs(STATE_DIR, 0700)
+        log = os.open(SERVER_LOG, os.O_WRONLY | os.O_CREAT | os.O_APPEND,
+                      0600)
+    except OSError:
+        log = null
+    os.dup2(log, 2)
+    try:
+        server_run(listener)
+    except ServerStop:
+        on_exit()
+    except:
+        sys.stderr.write('ted server died at %s\n' % time.ctime())
+        traceback.print_exc()
+        os._exit(1)
+    finally:
+        os._exit(0)
+
+def server_run(listener):
+    """Serve the terminals that attach, one after the other."""
+    sessions = Queue.Queue()
+    busy = threading.Lock()
+    thread = threading.Thread(target=server_accept,
+                              args=(listener, sessions, busy))
+    thread.daemon = True
+    thread.start()
+    init_signals()
+    CONFIG['serving'] = True
+    while True:
+        conn = sessions.get()
+        try:
+            server_session(conn)
+        finally:
+            conn.close()
+            busy.release()
+
+def server_accept(listener, sessions, busy):
+    """Hand each terminal that attaches to the main thread, or turn it away
+    while another is attached."""
+    while True:
+        conn = listener.accept()[0]
+        if busy.acquire(False):
+            sessions.put(conn)
+            continue
+        try:
+            conn.sendall('busy\n')
+        except socket.error:
+            pass
+        conn.close()
+
+def server_session(conn):
+    """Run the editor for the terminal on `conn` until it detaches."""
+    header = recv_line(conn)
+    if not header:
+        return
+    request = json.loads(header, object_hook=encode_json)
+    if request.get('stop'):
+        os.unlink(server_address())
+        conn.sendall('stopped %d\n' % editor_dirty_buffers())
+        raise ServerStop
+    conn.sendall('ok\n')
+    fd = conn.fileno()
+    rows, cols = request['size']
+    CONFIG['reported_size'] = {'screen_rows': rows, 'screen_cols': cols}
+    CONFIG['input'] = ''
+    CONFIG['keys'].clear()
+    try:
+        # Files opened and searched for in the session are found from
+        # where the terminal is, as they would be without the server.
+        os.chdir(request['cwd'])
+    except OSError:
+        pass
+    editor_resize(fd)
+    editor_open_files(request['files'], request['follow'])
+    try:
+        editor_run(fd)
+    except (SessionEnd, EOFError):
+        pass
+    except (OSError, socket.error) as err:
+        if err.errno not in (errno.EPIPE, errno.ECONNRESET):
+            raise
+    finally:
+        CONFIG['reported_size'] = None
+
+def recv_line(conn):
+    """Read one line from `conn` without reading past it, or return what
+    there was of it if the other end hung up."""
+    line = ''
+    while not line.endswith('\n'):
+        c = conn.recv(1)
+        if not c:
+            break
+        line += c
+    return line
+
+def client_attach(fd, filenames, follow):
+    """Attach the terminal on `fd` to the server, to edit `filenames` there.
+    Returns False if there is no server to attach to, or it is busy with
+    another terminal; otherwise returns once the terminal detaches."""
+    try:
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        conn.connect(server_address())
+    except (OSError, socket.error):
+        return False
+    size = get_window_size(fd)
+    conn.sendall(json.dumps({
+        'size': [size['screen_rows'], size['screen_cols']],
+        'files': [os.path.abspath(f) for f in filenames],
+        'follow': follow,
+        'cwd': os.getcwd(),
+    }) + '\n')
+    if recv_line(conn) != 'ok\n':
+        conn.close()
+        return False
+    enable_raw_mode(fd)
+    init_signals()
+    signals = CONFIG['signal_pipe'][0]
+    while True:
+        ready = wait_readable([fd, conn.fileno(), signals])
+        if signals in ready:
+            if chr(signal.SIGWINCH) in os.read(signals, 64):
+                size = get_window_size(fd)
+                conn.sendall('\x1b[8;%d;%dt' % (size['screen_rows'],
+                                                size['screen_cols']))
+        if fd in ready:
+            data = os.read(fd, INPUT_SIZE)
+            if not data:
+                break
+            conn.sendall(data)
+        if conn.fileno() in ready:
+            data = conn.recv(INPUT_SIZE)
+            if not data:
+                break
+            os.write(fd, data)
+    conn.close()
+    return True
+
+def client_stop_server():
+    """Stop the server. Returns its reply: 'stopped' with the number of
+    buffers left with unsaved edits, or 'busy' while a terminal is
+    attached; or None if there is no server."""
+    try:
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        conn.connect(server_address())
+    except (OSError, socket.error):
+        return None
+    try:
+        conn.sendall(json.dumps({'stop': True}) + '\n')
+        return recv_line(conn).strip()
+    finally:
+        conn.close()
+
 def init_editor(fd):
-    CONFIG.update(get_window_size(fd))
-    CONFIG['screen_rows'] -= 2
-    set_status_message('HELP: Ctrl-S = save | Ctrl-Q = quit | Ctrl-F = find')
+    editor_resize(fd)
+    init_signals()
+    set_status_message('HELP: Ctrl-S = save | Ctrl-Q = quit | Ctrl-F = find | '
+                       'Ctrl-O = open | Ctrl-N = next file')
 
 
 if __name__ == '__main__':
     import sys
 
+    args = sys.argv[1:]
+    if '--server' in args:
+        try:
+            print 'ted server listening on %s' % server_start()
+        except (OSError, socket.error) as e:
+            print >> sys.stderr, "Can't start the server: %s" % e.strerror
+            sys.exit(1)
+        sys.exit(0)
+    if '--stop-server' in args:
+        reply = client_stop_server()
+        if reply is None:
+            print >> sys.stderr, 'No ted server is running'
+            sys.exit(1)
+        if reply == 'busy':
+            print >> sys.stderr, ("The ted server can't be stopped while a "
+                                  "terminal is attached to it")
+            sys.exit(1)
+        dirty = int(reply.split()[1])
+        if dirty:
+            print ('ted server stopped; the unsaved edits in %d of its '
+                   'buffers will be recovered when their files are opened' %
+                   dirty)
+        else:
+            print 'ted server stopped'
+        sys.exit(0)
+    profile = os.environ.get('TED_PROFILE')
+    if '--profile' in args:
+        args.remove('--profile')
+        profile = profile or '1'
+    if '--cprofile' in args:
+        args.remove('--cprofile')
+        profile = 'cprofile'
+    if profile:
+        CONFIG['profiler'] = Profiler(cprofile=profile == 'cprofile')
+    follow = '--follow' in args
+    if follow:
+        args.remove('--follow')
+    attach = '--attach' in args
+    if attach:
+        args.remove('--attach')
+
     fd = sys.stdin.fileno()
+    pipe = None
+    if '-' in args:
+        # The text comes in on standard input, so the keys have to come
+        # from the terminal instead.
+        pipe = os.dup(fd)
+        try:
+            tty_fd = os.open('/dev/tty', os.O_RDWR)
+        except OSError as e:
+            print >> sys.stderr, "Can't open the terminal: %s" % e.strerror
+            sys.exit(1)
+        os.dup2(tty_fd, fd)
+        os.close(tty_fd)
+    # The server can't read this terminal's standard input.
+    if attach and pipe is None and client_attach(fd, args, follow):
+        sys.exit(0)
     enable_raw_mode(fd)
     init_editor(fd)
-    if len(sys.argv) > 1:
-        editor_open(sys.argv[1])
-
-    while True:
-        refresh_screen(fd)
-        process_key_press(fd)
+    editor_open_files(args, follow, pipe)
+    try:
+        editor_run(fd)
+    except EOFError:
+        sys.exit(0)